@@ -46,25 +46,38 @@ def print_error(msg):
 def extract_csts(
     inp_filenames,
     outp_dir,
-    cst_parser,
+    parser_class,
+    parser_options = {},
     suffix = '_cstext.txt',
     verbose_level = 1,
-    reference = None
+    reference = None,
+    jobs = 1,
+    output_format = 'text'
 ):
     tens_list = None
     if outp_dir != '':
         if not os.path.isdir(outp_dir):
             os.mkdir(outp_dir)
 
-    for fn in inp_filenames:
-        try:
-            print_info(
-                "Attempting to read file \"%s\"..." % fn
-            )
-            cst_parser.filename = fn
-            tens_list = cst_parser.read()
+    print_info(
+        "Reading %d files using %d process(es)..." % \
+            (len(inp_filenames), jobs)
+    )
+
+    archives = [fn for fn in inp_filenames if qmt.is_archive(fn)]
+    # output files written so far, which must not be overwritten
+    written = set()
+
+    try:
+        for (fn, tens_list) in qmt.nmr.parsers.read_files(
+            parser_class,
+            inp_filenames,
+            jobs = jobs,
+            **parser_options
+        ):
             print_info(
-                "Processed %d entries." % len(tens_list)
+                "Processed %d entries from file \"%s\"." % \
+                    (len(tens_list), fn)
             )
             tens_list.sort()
 
@@ -78,36 +91,114 @@ def extract_csts(
                     "Done."
                 )
 
-            prefix = os.path.splitext(fn)[0]
-            outp_filename = prefix + suffix
-
-            if outp_dir != '':
-                prefix = os.path.splitext(
-                    os.path.basename(fn)
-                )[0]
-                outp_filename = os.path.join(outp_dir, prefix) + suffix
+            archive = None
+            name = fn
+            for a in archives:
+                if fn.startswith(a + os.sep):
+                    archive = a
+                    name = fn[len(a) + 1:]
+                    break
+
+            if not qmt.util.fileio.is_plain_file(name):
+                # strip compression suffix
+                name = os.path.splitext(name)[0]
+
+            prefix = os.path.splitext(name)[0]
+
+            if archive is not None:
+                # members of tar archives are written next to the archive 
+                # (or to the output directory) keeping their paths in it
+                prefix = os.path.normpath(prefix).lstrip(os.sep)
+                if prefix.split(os.sep)[0] == os.pardir:
+                    print_error(
+                        "Member \"%s\" lies outside of the archive." % fn
+                    )
+
+                if outp_dir != '':
+                    prefix_dir = outp_dir
+                else:
+                    prefix_dir = os.path.dirname(archive)
+                outp_filename = os.path.join(prefix_dir, prefix) + suffix
+            elif outp_dir != '':
+                outp_filename = os.path.join(
+                    outp_dir,
+                    os.path.basename(prefix)
+                ) + suffix
+            else:
+                outp_filename = prefix + suffix
+
+            if os.path.abspath(outp_filename) in written:
+                print_error(
+                    "Entries of file \"%s\" would overwrite file \"%s\" " \
+                    "written before." % (fn, outp_filename)
+                )
+            written.add(os.path.abspath(outp_filename))
 
             print_info(
                 "Writing entries to file \"%s\"..." % outp_filename
             )
 
-            with open(outp_filename, 'w') as outp_file:
-                tens_list.write_to_file(
-                    outp_file,
-                    level = verbose_level,
-                    reference = reference
+            try:
+                outp_filename_dir = os.path.dirname(outp_filename)
+                if outp_filename_dir != '' and \
+                    not os.path.isdir(outp_filename_dir):
+                    os.makedirs(outp_filename_dir)
+
+                if output_format == 'binary':
+                    with open(outp_filename, 'wb') as outp_file:
+                        tens_list.write_binary(
+                            outp_file,
+                            reference = reference
+                        )
+                else:
+                    with open(outp_filename, 'w') as outp_file:
+                        tens_list.write_to_file(
+                            outp_file,
+                            level = verbose_level,
+                            reference = reference
+                        )
+            except IOError:
+                print_error(
+                    "I/O error during writing."
                 )
+            print_info("Success.")
 
-                print_info("Success.")
+    except qmt.nmr.parsers.NMRTensorReadError, e:
+        print_error(
+            "Failed to read file \"%s\": %s" % (e.filename, e)
+        )
 
-        except qmt.nmr.parsers.NMRTensorReadError, e:
-            print_error(e)
+    except IOError, e:
+        print_error(
+            "I/O error during reading of file \"%s\"." % e.filename
+        )
 
-        except IOError:
+def build_indexes(
+    inp_filenames,
+    parser_class,
+    parser_options = {}
+):
+    print_info(
+        "Building indexes of %d files..." % len(inp_filenames)
+    )
+
+    for fn in inp_filenames:
+        try:
+            index = parser_class(fn, **parser_options).build_index()
+            index.save()
+        except qmt.nmr.parsers.NMRTensorReadError, e:
             print_error(
-                "I/O error during writing."
+                "Failed to index file \"%s\": %s" % (fn, e)
+            )
+        except (IOError, OSError):
+            print_error(
+                "I/O error during indexing of file \"%s\"." % fn
             )
 
+        print_info(
+            "Indexed %d entries of file \"%s\"." % (len(index.blocks), fn)
+        )
+
 def extract_reference(
     reference_filename
 ):
@@ -139,7 +230,10 @@ def main():
 Gaussian and ADF QM calculations. This version is suited for processing of 
 multiple files.'''
 
-    usage = '''Usage: %prog [options] input_files'''
+    usage = '''Usage: %prog [options] input_files
+Input files may be compressed (.gz, .bz2, .xz) or stored in tar archives.
+Results of archive members are written next to the archive (or to the output
+directory) under the paths of the members in the archive.'''
 
     file_types_parsers = {
         'gaussian' : qmt.nmr.parsers.GaussianOutputParser,
@@ -158,8 +252,9 @@ multiple files.'''
         '-o',
         '--output-suffix',
         dest = 'suffix',
-        help = '''suffix for output filename(s). Defaults to \'_cstext.txt\'.''',
-        default = '_cstext.txt',
+        help = '''suffix for output filename(s). Defaults to \'_cstext.txt\' 
+(\'_cstext.npz\' for binary output).''',
+        default = None,
         metavar = 'SUFFIX',
     )
     opt_parser.add_option(
@@ -229,8 +324,86 @@ Default is to use input numbering''',
         default = 'input'
     )
 
+    opt_parser.add_option(
+        '-j',
+        '--jobs',
+        dest = 'jobs',
+        type = 'int',
+        help = '''Number of processes used to parse the input files in 
+parallel. Defaults to 1.''',
+        default = 1,
+        metavar = 'N'
+    )
+
+    opt_parser.add_option(
+        '--from-cartesian',
+        dest = 'from_cartesian',
+        action = 'store_true',
+        help = '''In case of Gaussian output, calculate the principal components 
+and axes by diagonalization of the full Cartesian shielding tensors instead of
+reading the printed values, which have lower precision.''',
+        default = False
+    )
+
+    opt_parser.add_option(
+        '--select',
+        dest = 'selection',
+        help = '''Read only selected atoms. The selection is a comma-separated 
+list of element symbols, atom indices and ranges of atom indices, e.g. 
+'C,N,1-50,72' selects carbon and nitrogen atoms with indices 1 to 50 or 72.''',
+        default = None,
+        metavar = 'SELECTION'
+    )
+
+    opt_parser.add_option(
+        '--format',
+        dest = 'output_format',
+        type = 'choice',
+        choices = ('text', 'binary'),
+        help = '''Format of the output: fixed-width 'text' or 'binary' 
+uncompressed NumPy .npz archive holding the data in full precision along with
+JSON header. Defaults to text.''',
+        default = 'text'
+    )
+
+    opt_parser.add_option(
+        '--build-index',
+        dest = 'build_index',
+        action = 'store_true',
+        help = '''Only build indexes of the input files instead of extracting 
+the tensors. The index is stored next to each input file and records the 
+positions of the NMR data, so that later reads of the file need not scan it.''',
+        default = False
+    )
+
+    opt_parser.add_option(
+        '--no-cache',
+        dest = 'use_cache',
+        action = 'store_false',
+        help = '''Do not use the cache of parsed files. By default, parsed 
+tensors are stored in the directory given by the PYQMTOOLS_CACHE_DIR 
+environment variable (~/.cache/pyqmtools if it is not set) and unchanged 
+files are not parsed again.''',
+        default = True
+    )
+
     (options, args) = opt_parser.parse_args()
 
+    selection = None
+    if options.selection is not None:
+        try:
+            selection = qmt.nmr.datastruct.AtomSelection.from_string(
+                options.selection
+            )
+        except ValueError, e:
+            opt_parser.error(str(e))
+
+
+    if options.suffix is None:
+        if options.output_format == 'binary':
+            options.suffix = '_cstext.npz'
+        else:
+            options.suffix = '_cstext.txt'
 
     if len(args) == 0:
         opt_parser.error('No input file name specified!')
@@ -253,19 +426,36 @@ Default is to use input numbering''',
     if options.ref_filename is not None:
         reference = extract_reference(options.ref_filename)
 
-    cst_parser = file_types_parsers[options.file_type](
-        '',
-        shielding_type = options.shield_type,
-        atom_numbering = options.numbering_type
-    )
+    parser_options = {
+        'shielding_type' : options.shield_type,
+        'atom_numbering' : options.numbering_type,
+        'columnar' : True,
+        'selection' : selection,
+        'from_cartesian' : options.from_cartesian
+    }
+
+    if options.use_cache:
+        parser_options['cache'] = qmt.nmr.cache.ParseCache()
+
+    if options.build_index:
+        build_indexes(
+            args,
+            file_types_parsers[options.file_type],
+            parser_options = parser_options
+        )
+        print_info("Finished.")
+        return
 
     extract_csts(
         args,
         options.outp_dir,
-        cst_parser,
+        file_types_parsers[options.file_type],
+        parser_options = parser_options,
         suffix = options.suffix,
         verbose_level = int(options.verbosity_level),
-        reference = reference
+        reference = reference,
+        jobs = options.jobs,
+        output_format = options.output_format
     )
 
     print_info("Finished.")
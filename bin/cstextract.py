@@ -50,7 +50,8 @@ A script to extract shielding tensor information from output of Gaussian
 and ADF QM calculations.'''
 
     usage = '''Usage: %prog [options] input_file [output_file] 
-Writes data to standard output when output file is not specified'''
+Writes data to standard output when output file is not specified. The input 
+file may be compressed (.gz, .bz2, .xz), '-' reads standard input.'''
 
     file_types_parsers = {
         'gaussian' : qmt.nmr.parsers.GaussianOutputParser,
@@ -91,10 +92,12 @@ ADF and Gaussian. Default is ADF.''',
         dest = 'shield_type',
         type = 'choice',
         choices = shielding_types.keys(),
+        action = 'append',
         help = '''In case of ADF NMR output, sets whether total, diamagnetic, 
-paramagnetic or spin-orbit shielding tensor is printed out. 
+paramagnetic or spin-orbit shielding tensor is printed out. The option can be 
+repeated to print out several types read in a single pass over the file.
 Defaults to total shielding tensor''',
-        default = 'total'
+        default = None
     )
 
     opt_parser.add_option(
@@ -121,10 +124,85 @@ Default is to use input numbering''',
         default = 'input'
     )
 
+    opt_parser.add_option(
+        '--stream',
+        dest = 'stream',
+        action = 'store_true',
+        help = '''Write entries to output as soon as they are read, in the order
+in which they appear in the input file, instead of reading the whole file 
+first and sorting the entries by atom index.''',
+        default = False
+    )
+
+    opt_parser.add_option(
+        '--format',
+        dest = 'output_format',
+        type = 'choice',
+        choices = ('text', 'binary'),
+        help = '''Format of the output: fixed-width 'text' or 'binary' 
+uncompressed NumPy .npz archive holding the data in full precision along with
+JSON header. Defaults to text.''',
+        default = 'text'
+    )
+
+    opt_parser.add_option(
+        '--from-cartesian',
+        dest = 'from_cartesian',
+        action = 'store_true',
+        help = '''In case of Gaussian output, calculate the principal components 
+and axes by diagonalization of the full Cartesian shielding tensors instead of
+reading the printed values, which have lower precision.''',
+        default = False
+    )
+
+    opt_parser.add_option(
+        '--select',
+        dest = 'selection',
+        help = '''Read only selected atoms. The selection is a comma-separated 
+list of element symbols, atom indices and ranges of atom indices, e.g. 
+'C,N,1-50,72' selects carbon and nitrogen atoms with indices 1 to 50 or 72.''',
+        default = None,
+        metavar = 'SELECTION'
+    )
+
     (options, args) = opt_parser.parse_args()
 
+    selection = None
+    if options.selection is not None:
+        try:
+            selection = qmt.nmr.datastruct.AtomSelection.from_string(
+                options.selection
+            )
+        except ValueError, e:
+            opt_parser.error(str(e))
+
+    shield_types = []
+    for t in options.shield_type or ['total']:
+        if t not in shield_types:
+            shield_types.append(t)
+
+    if len(shield_types) > 1:
+        if options.file_type != 'adf':
+            opt_parser.error(
+                'Multiple shielding types can be read only from ADF outputs!'
+            )
+        if options.stream:
+            opt_parser.error(
+                'Multiple shielding types can not be written in stream mode!'
+            )
+
+    if options.output_format == 'binary':
+        if len(args) < 2:
+            opt_parser.error(
+                'Binary output can not be written to standard output!'
+            )
+        if options.stream or len(shield_types) > 1:
+            opt_parser.error(
+                'Binary output holds single list and can not be streamed!'
+            )
+
     outp_file = None
-    tens_list = None
+    tens_lists = None
 
     if len(args) == 0:
         opt_parser.error('No input file name specified!')
@@ -149,19 +227,40 @@ Default is to use input numbering''',
     try:
         p = file_types_parsers[options.file_type](
             args[0],
-            shielding_type = options.shield_type,
-            atom_numbering = options.numbering_type
+            shielding_type = shield_types[0],
+            atom_numbering = options.numbering_type,
+            columnar = True,
+            selection = selection,
+            from_cartesian = options.from_cartesian
         )
-        tens_list = p.read()
-        tens_list.sort()
+        if options.stream:
+            # only the header holder, tensors are written as they are read
+            tens_lists = [
+                qmt.nmr.datastruct.TensorList(
+                    filename = args[0],
+                    file_type = p._file_type,
+                    shielding_type = p.shielding_type
+                )
+            ]
+        elif len(shield_types) > 1:
+            tens_dict = p.read_multiple(shield_types)
+            tens_lists = [tens_dict[t] for t in shield_types]
+        else:
+            tens_lists = [p.read()]
+
+        for tens_list in tens_lists:
+            tens_list.sort()
 
     except qmt.nmr.parsers.NMRTensorReadError, e:
         print_error(e)
         
+    if not options.stream:
+        for tens_list in tens_lists:
+            print_info(
+                "Processed %d entries of %s shielding." % \
+                    (len(tens_list), tens_list.shielding_type)
+            )
 
-    print_info(
-        "Processed %d entries." % len(tens_list)
-    )
     reference = None
     if options.ref_filename is not None:
         print_info(
@@ -185,18 +284,23 @@ Default is to use input numbering''',
             "Other nuclei will NOT be referenced."
         )
 
-        print_info(
-            "Referencing entries..."
-        )
-        reference.transform_tensor_list(tens_list)
+        if not options.stream:
+            print_info(
+                "Referencing entries..."
+            )
+            for tens_list in tens_lists:
+                reference.transform_tensor_list(tens_list)
 
-        print_info(
-            "Done."
-        )
+            print_info(
+                "Done."
+            )
 
     try:
         if len(args) >= 2:
-            outp_file = open(args[1], 'w')
+            if options.output_format == 'binary':
+                outp_file = open(args[1], 'wb')
+            else:
+                outp_file = open(args[1], 'w')
             print_info(
                 "Writing entries to file \"%s\"..." % args[1]
             )
@@ -206,14 +310,30 @@ Default is to use input numbering''',
                 "Writing entries to standard output..."
             )
 
-        tens_list.write_to_file(
-            outp_file,
-            level = int(options.verbosity_level),
-            reference = reference
-        )
+        if options.stream:
+            tens_lists[0].write_tensors(
+                outp_file,
+                p.iter_tensors(),
+                level = int(options.verbosity_level),
+                reference = reference
+            )
+        elif options.output_format == 'binary':
+            tens_lists[0].write_binary(
+                outp_file,
+                reference = reference
+            )
+        else:
+            for tens_list in tens_lists:
+                tens_list.write_to_file(
+                    outp_file,
+                    level = int(options.verbosity_level),
+                    reference = reference
+                )
 
 
         print_info("Successfully written data to file/std. output.")
+    except qmt.nmr.parsers.NMRTensorReadError, e:
+        print_error(e)
     except IOError:
         print_error(
             "I/O error during writing."
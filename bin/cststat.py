@@ -5,6 +5,10 @@ from optparse import OptionParser
 import sys
 from time import strftime, localtime
 import os
+import shutil
+import tempfile
+import random
+from math import sqrt, ceil, floor
 from numpy import mean, std
 
 def print_time():
@@ -46,33 +50,240 @@ def print_error(msg):
         message
     )
 
+def order_filenames(
+    filenames,
+    order = 'given',
+    seed = None
+):
+    '''
+    return input files in the order they are read: as given, shuffled or 
+    strided (every k-th file, k being square root of their number, then every 
+    k-th starting with the second one etc.), so that the first files read 
+    cover the whole series
+    '''
+    filenames = list(filenames)
+
+    if order == 'random':
+        random.Random(seed).shuffle(filenames)
+    elif order == 'strided':
+        stride = max(1, int(ceil(sqrt(len(filenames)))))
+        filenames = [
+            fn for k in xrange(stride) for fn in filenames[k::stride]
+        ]
+
+    return filenames
+
+def get_input_filename(name, archives):
+    '''
+    return the input file tensors called 'name' were read from, i.e. the
+    archive for its members
+    '''
+    for fn in archives:
+        if name.startswith(fn + os.sep):
+            return fn
+
+    return name
+
 def extract_csts(
     inp_filenames,
     series_dir,
-    cst_parser,
+    parser_class,
+    parser_options = {},
     stat_filename = 'cststat.txt',
     verbose_level = 1,
     reference = None,
     quiet = False,
-    max_index = 0
+    max_index = 0,
+    state_filename = None,
+    jobs = 1,
+    output_format = 'text',
+    components = ('iso',),
+    error_method = 'naive',
+    resume_filename = None,
+    order = 'given',
+    seed = None,
+    target_ci = None,
+    min_snapshots = 10,
+    convergence_filename = None,
+    convergence_stride = 1,
+    histogram_width = None,
+    histogram_bins = 200,
+    histogram_origin = None,
+    percentiles = (5, 25, 50, 75, 95),
+    read_options = None,
+    reread_changed = False
 ):
     tens_list = None
-    tens_stat = qmt.nmr.datastruct.TensorStats(
-        filenames = inp_filenames,
-    )
-
-    for fn in inp_filenames:
+    resumed = resume_filename is not None and os.path.exists(resume_filename)
+    sample_store = None
+    if series_dir != '':
         try:
+            sample_store = qmt.nmr.samples.SampleStore(series_dir)
+        except ValueError, e:
+            print_error(e)
+
+        # errors are estimated from all the snapshots in the store, which
+        # must be those of the statistics
+        if len(sample_store) > 0 and not resumed:
+            print_error(
+                "Sample store in directory \"%s\" already holds %d " \
+                "snapshots, use an empty directory or resume the " \
+                "statistics they belong to." % \
+                    (series_dir, len(sample_store))
+            )
+
+        print_info(
+            "Appending samples to the store in directory \"%s\"" % \
+                series_dir,
+             quiet
+        )
+
+    shift_elements = ()
+    if reference is not None:
+        shift_elements = reference.refs.keys()
+
+    if resumed:
+        tens_stat = resume_stats(
+            resume_filename,
+            sample_store = sample_store,
+            error_method = error_method,
+            quiet = quiet
+        )
+        if tens_stat.shift_elements != sorted(shift_elements):
+            print_error(
+                "References of the state \"%s\" differ from the current ones."\
+                    % resume_filename
+            )
+
+        if tens_stat.read_options is None:
             print_info(
-                "Attempting to read file \"%s\"..." % fn,
+                "State \"%s\" does not record the options the files were " \
+                "read with, they can not be checked." % resume_filename,
                 quiet
             )
-            cst_parser.filename = fn
-            cst_parser.max_index = max_index
-            tens_list = cst_parser.read()
+        elif tens_stat.read_options != read_options:
+            print_error(
+                "Files of the state \"%s\" were read with different " \
+                "options: %s." % (
+                    resume_filename,
+                    ', '.join(
+                        sorted(
+                            k for k in set(tens_stat.read_options) | \
+                                set(read_options)
+                            if tens_stat.read_options.get(k) != \
+                                read_options.get(k)
+                        )
+                    )
+                )
+            )
+
+        histograms = tens_stat.histograms
+        if (histograms is None and histogram_width is not None) or \
+            (histograms is not None and (histogram_width is None or \
+                histograms.width != histogram_width or \
+                histograms.n_bins != histogram_bins or \
+                histograms.fixed_origin != histogram_origin)):
+            print_error(
+                "Histograms of the state \"%s\" differ from the current ones."\
+                    % resume_filename
+            )
+    else:
+        tens_stat = qmt.nmr.datastruct.TensorStats(
+            filenames = [],
+            sample_store = sample_store,
+            shift_elements = shift_elements,
+            error_method = error_method,
+            histogram_width = histogram_width,
+            histogram_bins = histogram_bins,
+            histogram_origin = histogram_origin,
+            read_options = read_options
+        )
+
+    def check_changed(name, identity):
+        '''
+        refuse to read again file (or archive member) which was added before
+        it changed, unless 'reread_changed' is set
+        '''
+        if not tens_stat.is_changed(identity):
+            return
+        if not reread_changed:
+            print_error(
+                "File \"%s\" changed since it was processed, use " \
+                "'--reread-changed' to add all its snapshots again." % name
+            )
+        print_info(
+            "File \"%s\" changed since it was processed, all its " \
+            "snapshots are added again." % name,
+            quiet
+        )
+
+    # identities of input files recorded after they are read, standard 
+    # input can not be identified. Members of archives are recorded one by
+    # one, so that archives read only partially are not skipped as a whole
+    identities = {}
+    new_filenames = []
+    for fn in inp_filenames:
+        if fn != qmt.util.fileio.STDIN_NAME and os.path.isfile(fn):
+            identities[fn] = qmt.nmr.cache.file_identity(fn)
+            if tens_stat.is_ingested(identities[fn]):
+                continue
+            if not qmt.is_archive(fn):
+                check_changed(fn, identities[fn])
+        new_filenames.append(fn)
+
+    if len(new_filenames) < len(inp_filenames):
+        print_info(
+            "Skipping %d files already processed." % \
+                (len(inp_filenames) - len(new_filenames)),
+            quiet
+        )
+    new_filenames = order_filenames(new_filenames, order, seed)
+    archives = [fn for fn in new_filenames if qmt.is_archive(fn)]
+
+    print_info(
+        "Reading %d files using %d process(es)..." % \
+            (len(new_filenames), jobs),
+        quiet
+    )
+
+    parser_options = dict(parser_options, max_index = max_index)
+
+    member_identities = {}
+    skipped_members = []
+
+    def skip_member(archive, member):
+        if archive == qmt.util.fileio.STDIN_NAME:
+            return False
+
+        identity = qmt.nmr.cache.member_identity(archive, member)
+        if tens_stat.is_ingested(identity):
+            skipped_members.append(member.name)
+            return True
+        check_changed(os.path.join(archive, member.name), identity)
+
+        member_identities[os.path.join(archive, member.name)] = identity
+        return False
+
+    # samples appended to the store must keep the order of files
+    results = qmt.nmr.parsers.read_files(
+        parser_class,
+        new_filenames,
+        jobs = jobs,
+        ordered = (sample_store is not None),
+        skip_member = skip_member,
+        **parser_options
+    )
+    # input files (at least partially) read
+    read_filenames = []
+    n_snapshots = 0
+    converged = False
+
+    try:
+        for (fn, tens_list) in results:
             if not quiet:
                 print_info(
-                    "Processed %d entries." % len(tens_list),
+                    "Processed %d entries from file \"%s\"." % \
+                        (len(tens_list), fn),
                     quiet
                 )
             tens_list.sort()
@@ -93,59 +304,242 @@ def extract_csts(
                 tens_list
             )
 
-        except qmt.nmr.parsers.NMRTensorReadError, e:
-            print_error(e)
+            n_snapshots += 1
+            if fn in member_identities:
+                tens_stat.add_ingested(member_identities[fn])
+            source = get_input_filename(fn, archives)
+            if len(read_filenames) == 0 or read_filenames[-1] != source:
+                read_filenames.append(source)
 
-        except IOError:
-            print_error(
-                "I/O error during writing."
+            if target_ci is not None and tens_stat.is_converged(
+                target_ci,
+                components = components,
+                min_count = min_snapshots
+            ):
+                converged = True
+                break
+
+    except qmt.nmr.parsers.NMRTensorReadError, e:
+        print_error(
+            "Failed to read file \"%s\": %s" % (e.filename, e)
+        )
+
+    except ValueError, e:
+        print_error(e)
+
+    except IOError, e:
+        print_error(
+            "I/O error during reading of file \"%s\"." % e.filename
+        )
+
+    finally:
+        # stops parsing of the remaining files
+        results.close()
+
+    tens_stat.filenames = list(tens_stat.filenames) + read_filenames
+    for fn in read_filenames:
+        if fn in identities and fn not in archives:
+            tens_stat.add_ingested(identities[fn])
+
+    if len(skipped_members) > 0:
+        print_info(
+            "Skipped %d archive members already processed." % \
+                len(skipped_members),
+            quiet
+        )
+
+    if target_ci is not None:
+        if converged:
+            print_info(
+                "Confidence intervals of all atoms are below %g after %d " \
+                "snapshots, %d input files were not read." % (
+                    target_ci,
+                    n_snapshots,
+                    len(new_filenames) - len(read_filenames)
+                )
+            )
+        else:
+            print_info(
+                "Confidence intervals did not get below %g with all %d " \
+                "snapshots." % (target_ci, n_snapshots)
+            )
+
+    write_stats(
+        tens_stat,
+        stat_filename,
+        state_filename = state_filename,
+        quiet = quiet,
+        output_format = output_format,
+        components = components,
+        percentiles = percentiles
+    )
+
+    if convergence_filename is not None:
+        write_convergence(
+            tens_stat,
+            convergence_filename,
+            stride = convergence_stride,
+            quiet = quiet
+        )
+
+def write_convergence(
+    tens_stat,
+    convergence_filename,
+    stride = 1,
+    quiet = False
+):
+    print_info(
+        "Writing convergence traces to file \"%s\"..." % \
+            convergence_filename,
+        quiet
+    )
+    try:
+        with open(convergence_filename, 'wb') as f:
+            tens_stat.write_convergence(
+                f,
+                stride = stride
+            )
+    except ValueError, e:
+        print_error(e)
+    except IOError:
+        print_error(
+            "I/O error during writing."
+        )
+    print_info(
+        "Success.",
+        quiet
+    )
+
+def resume_stats(
+    resume_filename,
+    sample_store = None,
+    error_method = 'naive',
+    quiet = False
+):
+    print_info(
+        "Resuming statistics from state file \"%s\"..." % resume_filename,
+        quiet
+    )
+    try:
+        with open(resume_filename, 'rb') as f:
+            tens_stat = qmt.nmr.datastruct.TensorStats.load_state(
+                f,
+                sample_store = sample_store,
+                error_method = error_method
             )
+    except ValueError, e:
+        print_error(e)
+    except IOError:
+        print_error(
+            "I/O error during reading."
+        )
+
+    print_info(
+        "Found statistics of %d files." % len(tens_stat.ingested),
+        quiet
+    )
+    return tens_stat
+
+def write_stats(
+    tens_stat,
+    stat_filename,
+    state_filename = None,
+    quiet = False,
+    output_format = 'text',
+    components = ('iso',),
+    percentiles = (5, 25, 50, 75, 95)
+):
     if not quiet:
         print_info(
             "Calculating statistics and writing entries to file \"%s\"..." % \
                 stat_filename,
              quiet
         )
-    with open(stat_filename, 'w') as f:
-        tens_stat.write_stats(
-            f
-        )
+    try:
+        if output_format == 'binary':
+            with open(stat_filename, 'wb') as f:
+                tens_stat.write_binary(
+                    f
+                )
+        else:
+            with open(stat_filename, 'w') as f:
+                tens_stat.write_stats(
+                    f,
+                    components = components
+                )
+                if tens_stat.histograms is not None:
+                    tens_stat.write_percentiles(
+                        f,
+                        percentiles = percentiles
+                    )
+    except ValueError, e:
+        print_error(e)
     print_info(
         "Success.",
         quiet
     )
-    if series_dir != '':
+
+    if state_filename is not None:
         print_info(
-            "Writing individual samples to files in directory \"%s\"" % \
-                series_dir,
+            "Saving state of statistics to file \"%s\"..." % \
+                state_filename,
              quiet
         )
-        fname = ""
-        if not os.path.isdir(series_dir):
-            os.mkdir(series_dir)
-            
-        for k in tens_stat.data:
-
-            fname = "%06d%s_samples.txt" % (
-                k, 
-                tens_stat.data[k][0].element
-            )
-
-            full_path_name = os.path.join(
-                series_dir,
-                fname
+        try:
+            with open(state_filename, 'wb') as f:
+                tens_stat.save_state(f)
+        except IOError:
+            print_error(
+                "I/O error during writing."
             )
-            with open(full_path_name, 'w') as f:
-                tens_stat.write_tensors(
-                    k,
-                    f
-                )
         print_info(
             "Success.",
             quiet
         )
-                
-        
+
+def merge_stats(
+    inp_filenames,
+    stat_filename = 'cststat.txt',
+    state_filename = None,
+    quiet = False,
+    output_format = 'text',
+    components = ('iso',),
+    percentiles = (5, 25, 50, 75, 95)
+):
+    tens_stat = None
+
+    for fn in inp_filenames:
+        print_info(
+            "Merging statistics from state file \"%s\"..." % fn,
+            quiet
+        )
+        try:
+            with open(fn, 'rb') as f:
+                part = qmt.nmr.datastruct.TensorStats.load_state(f)
+        except ValueError, e:
+            print_error(e)
+        except IOError:
+            print_error(
+                "I/O error during reading."
+            )
+
+        if tens_stat is None:
+            tens_stat = part
+        else:
+            try:
+                tens_stat.merge(part)
+            except ValueError, e:
+                print_error(e)
+
+    write_stats(
+        tens_stat,
+        stat_filename,
+        state_filename = state_filename,
+        quiet = quiet,
+        output_format = output_format,
+        components = components,
+        percentiles = percentiles
+    )
 
 def extract_reference(
     reference_filename,
@@ -182,7 +576,9 @@ def main():
 print a number statistical descriptors (sample mean, sample standard deviation,
  standard error of the mean) for each nucleus.'''
 
-    usage = '''Usage: %prog [options] input_files'''
+    usage = '''Usage: %prog [options] input_files
+Input files may be compressed (.gz, .bz2, .xz) or stored in tar archives, 
+whose members are read one by one without extracting them to disk.'''
 
     file_types_parsers = {
         'gaussian' : qmt.nmr.parsers.GaussianOutputParser,
@@ -202,17 +598,19 @@ print a number statistical descriptors (sample mean, sample standard deviation,
         '--output-filename',
         dest = 'outp_file',
         help = '''Name of the main output file containing statistics. 
-Defaults to \'cststat.txt\'.''',
-        default = 'cststat.txt',
+Defaults to \'cststat.txt\' (\'cststat.npz\' for binary output).''',
+        default = None,
         metavar = 'FILENAME',
     )
     opt_parser.add_option(
         '-d',
         '--series-directory',
         dest = 'series_dir',
-        help = '''Optional directory which can store values of all samples for 
-each nucleus as a separate file. Can potentially result in a large number of 
-files.''',
+        help = '''Optional directory holding the store of all samples, i.e. 
+single array of isotropic values, principal components and the other 
+descriptors (see '--component') of all nuclei in all input files, which can be 
+memory-mapped for further analysis. Samples are appended to an existing store
+only when resuming the statistics (see '--resume') the store belongs to.''',
         default = '',
         metavar = 'SERIES_DIR'
     )
@@ -259,6 +657,59 @@ system contains molecules which are of no interest (like solvent for example).
         default = 0,
         metavar = 'INDEX'
     )
+    opt_parser.add_option(
+        '-j',
+        '--jobs',
+        dest = 'jobs',
+        type = 'int',
+        help = '''Number of processes used to parse the input files in 
+parallel. Defaults to 1.''',
+        default = 1,
+        metavar = 'N'
+    )
+    opt_parser.add_option(
+        '-S',
+        '--save-state',
+        dest = 'state_filename',
+        help = '''Save the state of statistics to binary file, which can be later
+merged with the results of other runs (e.g. processing different sets of 
+snapshots) using '--merge'.''',
+        default = None,
+        metavar = 'FILENAME'
+    )
+    opt_parser.add_option(
+        '-R',
+        '--resume',
+        dest = 'resume_filename',
+        help = '''Continue the statistics saved in state file, which is 
+created if it does not exist. Input files already processed (identified by 
+their path, size and modification time) are skipped, only new files are read
+and the updated state is saved back to the file (unless '--save-state' names
+another one). Files processed before they changed are not read again unless 
+'--reread-changed' is given. The files must be read with the same options 
+(type, shielding type, selection etc.). Use the same '--series-directory' in 
+all the runs to keep the samples.''',
+        default = None,
+        metavar = 'FILENAME'
+    )
+
+    opt_parser.add_option(
+        '--reread-changed',
+        dest = 'reread_changed',
+        action = 'store_true',
+        help = '''Read again files which changed since they were processed 
+in the resumed statistics (see '--resume'), e.g. archives with new members 
+appended, although their snapshots added before are counted twice.''',
+        default = False
+    )
+    opt_parser.add_option(
+        '--merge',
+        dest = 'merge',
+        action = 'store_true',
+        help = '''Treat input files as state files written by '--save-state',
+merge them and write the resulting statistics.''',
+        default = False
+    )
 #    opt_parser.add_option(
 #        '-l',
 #        '--verbosity-level',
@@ -292,8 +743,240 @@ Default is to use input numbering''',
         default = 'input'
     )
 
+    opt_parser.add_option(
+        '--from-cartesian',
+        dest = 'from_cartesian',
+        action = 'store_true',
+        help = '''In case of Gaussian output, calculate the principal components 
+and axes by diagonalization of the full Cartesian shielding tensors instead of
+reading the printed values, which have lower precision.''',
+        default = False
+    )
+
+    opt_parser.add_option(
+        '--select',
+        dest = 'selection',
+        help = '''Read only selected atoms. The selection is a comma-separated 
+list of element symbols, atom indices and ranges of atom indices, e.g. 
+'C,N,1-50,72' selects carbon and nitrogen atoms with indices 1 to 50 or 72.''',
+        default = None,
+        metavar = 'SELECTION'
+    )
+
+    opt_parser.add_option(
+        '--format',
+        dest = 'output_format',
+        type = 'choice',
+        choices = ('text', 'binary'),
+        help = '''Format of the output: fixed-width 'text' or 'binary' 
+uncompressed NumPy .npz archive holding the data in full precision along with
+JSON header. Defaults to text.''',
+        default = 'text'
+    )
+
+    opt_parser.add_option(
+        '-c',
+        '--component',
+        dest = 'components',
+        type = 'choice',
+        choices = qmt.nmr.datastruct.TensorStats.get_component_names(),
+        action = 'append',
+        help = '''Component whose statistics are written to the text output,
+can be given more times. Apart from the isotropic value ('iso') and the 
+principal components ('11', '22', '33', ordered according to Mehring), the
+Herzfeld-Berger 'span' and 'skew' and Haeberlen 'anisotropy', 
+'reduced_anisotropy' and 'asymmetry' are available. Nuclei with secondary 
+reference are treated as chemical shifts, the others as shieldings. Defaults
+to the isotropic value only, binary output always holds all components.''',
+        default = None,
+        metavar = 'COMPONENT'
+    )
+
+    opt_parser.add_option(
+        '--error-method',
+        dest = 'error_method',
+        type = 'choice',
+        choices = qmt.nmr.datastruct.TensorStats._error_methods,
+        help = '''Method of estimation of the standard error of the mean and
+of the confidence interval. 'naive' assumes independent samples, which 
+consecutive MD snapshots are not. 'block' uses blocking transformation, 
+'inefficiency' corrects the naive error by statistical inefficiency calculated
+from autocorrelation functions and 'bootstrap' gives percentile confidence 
+intervals of moving block bootstrap. These methods need all the samples in the
+order of input files, which are kept in the store given by '-d' (or in 
+temporary one). Defaults to naive.''',
+        default = 'naive'
+    )
+
+    opt_parser.add_option(
+        '--convergence',
+        dest = 'convergence_filename',
+        help = '''Write convergence traces, i.e. cumulative mean and (naive)
+95% confidence interval of all components of every atom versus the number of 
+snapshots read, to binary file (uncompressed NumPy .npz archive with arrays 
+'snapshots', 'count', 'mean' and 'ci'). The samples are kept in the store 
+given by '-d' (or in temporary one).''',
+        default = None,
+        metavar = 'FILENAME'
+    )
+
+    opt_parser.add_option(
+        '--convergence-stride',
+        dest = 'convergence_stride',
+        type = 'int',
+        help = '''Record the convergence traces after every N-th snapshot 
+(and after the last one). Defaults to 1.''',
+        default = 1,
+        metavar = 'N'
+    )
+
+    opt_parser.add_option(
+        '--histogram-width',
+        dest = 'histogram_width',
+        type = 'float',
+        help = '''Keep histogram of isotropic values of every atom with bins
+of width WIDTH, which are aligned to multiples of WIDTH. Percentiles (see
+'--percentiles') estimated from the histograms are written to the text output,
+the histograms themselves to the binary output and to the state file. Merged
+histograms (see '--merge') are exact only with '--histogram-range'.''',
+        default = None,
+        metavar = 'WIDTH'
+    )
+
+    opt_parser.add_option(
+        '--histogram-bins',
+        dest = 'histogram_bins',
+        type = 'int',
+        help = '''Number of bins of every histogram, centred on the first
+value of the atom, values outside the bins are only counted. As the first
+values differ between runs, counts of merged histograms outside the bins of
+the first one are only counted as well. Defaults to 200.''',
+        default = 200,
+        metavar = 'N'
+    )
+
+    opt_parser.add_option(
+        '--histogram-range',
+        dest = 'histogram_range',
+        help = '''Comma-separated lower and upper bound of the bins of all the
+histograms (instead of '--histogram-bins'), values outside are only counted.
+Histograms with the same range and width are merged exactly, whatever the
+order of the snapshots.''',
+        default = None,
+        metavar = 'LOW,HIGH'
+    )
+
+    opt_parser.add_option(
+        '--percentiles',
+        dest = 'percentiles',
+        help = '''Comma-separated list of percentiles written when histograms
+are kept. Defaults to 5,25,50,75,95.''',
+        default = '5,25,50,75,95',
+        metavar = 'LIST'
+    )
+
+    opt_parser.add_option(
+        '--target-ci',
+        dest = 'target_ci',
+        type = 'float',
+        help = '''Stop reading input files once the 95% confidence intervals 
+(estimated by the method given by '--error-method') of the components written
+(see '--component') of all atoms are below VALUE and report the number of 
+snapshots needed.''',
+        default = None,
+        metavar = 'VALUE'
+    )
+
+    opt_parser.add_option(
+        '--min-snapshots',
+        dest = 'min_snapshots',
+        type = 'int',
+        help = '''Minimal number of samples of every atom before reading 
+is stopped by '--target-ci'. Defaults to 10.''',
+        default = 10,
+        metavar = 'N'
+    )
+
+    opt_parser.add_option(
+        '--order',
+        dest = 'order',
+        type = 'choice',
+        choices = ('given', 'random', 'strided'),
+        help = '''Order in which the input files are read: 'given' on the 
+command line, 'random' or 'strided' (every k-th file with k being square root
+of the number of files, then every k-th starting with the second one etc.). 
+The two latter orders make the first files read cover the whole series, which
+is useful with '--target-ci'. Defaults to given.''',
+        default = 'given'
+    )
+
+    opt_parser.add_option(
+        '--seed',
+        dest = 'seed',
+        type = 'int',
+        help = "Seed of random order of input files.",
+        default = None,
+        metavar = 'SEED'
+    )
+
+    opt_parser.add_option(
+        '--no-cache',
+        dest = 'use_cache',
+        action = 'store_false',
+        help = '''Do not use the cache of parsed files. By default, parsed 
+tensors are stored in the directory given by the PYQMTOOLS_CACHE_DIR 
+environment variable (~/.cache/pyqmtools if it is not set) and unchanged 
+files are not parsed again.''',
+        default = True
+    )
+
     (options, args) = opt_parser.parse_args()
 
+    selection = None
+    if options.selection is not None:
+        try:
+            selection = qmt.nmr.datastruct.AtomSelection.from_string(
+                options.selection
+            )
+        except ValueError, e:
+            opt_parser.error(str(e))
+
+
+    if options.components is None:
+        options.components = ['iso']
+
+    try:
+        percentiles = [float(p) for p in options.percentiles.split(',')]
+    except ValueError:
+        opt_parser.error('Invalid list of percentiles!')
+    if len(percentiles) == 0 or min(percentiles) < 0 or max(percentiles) > 100:
+        opt_parser.error('Percentiles must be between 0 and 100!')
+
+    if options.histogram_width is not None and options.histogram_width <= 0:
+        opt_parser.error('Width of histogram bins must be positive!')
+    if options.histogram_bins < 1:
+        opt_parser.error('Histograms must have at least one bin!')
+
+    histogram_origin = None
+    if options.histogram_range is not None:
+        if options.histogram_width is None:
+            opt_parser.error('Range of histograms requires width of bins!')
+        try:
+            (low, high) = [float(b) for b in options.histogram_range.split(',')]
+        except ValueError:
+            opt_parser.error('Invalid range of histograms!')
+        if high <= low:
+            opt_parser.error('Upper bound of histograms must exceed the lower!')
+
+        histogram_origin = int(floor(low / options.histogram_width))
+        options.histogram_bins = int(ceil(high / options.histogram_width)) - \
+            histogram_origin
+
+    if options.outp_file is None:
+        if options.output_format == 'binary':
+            options.outp_file = 'cststat.npz'
+        else:
+            options.outp_file = 'cststat.txt'
 
     if len(args) == 0:
         opt_parser.error('No input file name specified!')
@@ -312,25 +995,126 @@ Default is to use input numbering''',
             "%s" % str(o)
         )
         
+    if options.merge:
+        if options.series_dir != '':
+            opt_parser.error(
+                'Individual samples can not be written when merging states!'
+            )
+        if options.error_method != 'naive':
+            opt_parser.error(
+                'Only naive errors can be estimated when merging states!'
+            )
+        if options.resume_filename is not None:
+            opt_parser.error(
+                'States can not be resumed when merging them!'
+            )
+        if options.target_ci is not None:
+            opt_parser.error(
+                'Reading can not be stopped early when merging states!'
+            )
+        if options.convergence_filename is not None:
+            opt_parser.error(
+                'Convergence traces can not be written when merging states!'
+            )
+
+        merge_stats(
+            args,
+            stat_filename = options.outp_file,
+            state_filename = options.state_filename,
+            quiet = options.quiet,
+            output_format = options.output_format,
+            components = options.components,
+            percentiles = percentiles
+        )
+        print_info("Finished.")
+        return
+
     reference = None
     if options.ref_filename is not None:
         reference = extract_reference(options.ref_filename, options.quiet)
 
-    cst_parser = file_types_parsers[options.file_type](
-        '',
-        shielding_type = options.shield_type,
-        atom_numbering = options.numbering_type,
-    )
+    parser_options = {
+        'shielding_type' : options.shield_type,
+        'atom_numbering' : options.numbering_type,
+        'columnar' : True,
+        'selection' : selection,
+        'from_cartesian' : options.from_cartesian
+    }
 
-    extract_csts(
-        args,
-        options.series_dir,
-        cst_parser,
-        stat_filename = options.outp_file,
-        reference = reference,
-        quiet = options.quiet,
-        max_index = options.max_index
-    )
+    # options changing the values read, kept in the state
+    read_options = {
+        'file_type' : options.file_type,
+        'shielding_type' : options.shield_type,
+        'atom_numbering' : options.numbering_type,
+        'max_index' : options.max_index,
+        'selection' : None if selection is None else str(selection),
+        'from_cartesian' : options.from_cartesian
+    }
+
+    if options.use_cache:
+        parser_options['cache'] = qmt.nmr.cache.ParseCache()
+
+    if options.order != 'given' and options.error_method != 'naive':
+        opt_parser.error(
+            'Errors of correlated samples need input files in the given ' \
+            'order!'
+        )
+
+    if options.convergence_stride < 1:
+        opt_parser.error('Stride of convergence traces must be positive!')
+
+    # both need all the samples
+    needs_samples = options.error_method != 'naive' or \
+        options.convergence_filename is not None
+
+    if options.resume_filename is not None:
+        if needs_samples and options.series_dir == '':
+            opt_parser.error(
+                'Resumed statistics can estimate other than naive errors ' \
+                'or convergence only from samples kept in the series ' \
+                'directory!'
+            )
+        if options.state_filename is None:
+            options.state_filename = options.resume_filename
+
+    series_dir = options.series_dir
+    temp_dir = None
+    if needs_samples and series_dir == '':
+        temp_dir = tempfile.mkdtemp(prefix = 'cststat')
+        series_dir = temp_dir
+
+    try:
+        extract_csts(
+            args,
+            series_dir,
+            file_types_parsers[options.file_type],
+            parser_options = parser_options,
+            stat_filename = options.outp_file,
+            reference = reference,
+            quiet = options.quiet,
+            max_index = options.max_index,
+            state_filename = options.state_filename,
+            jobs = options.jobs,
+            output_format = options.output_format,
+            components = options.components,
+            error_method = options.error_method,
+            resume_filename = options.resume_filename,
+            order = options.order,
+            seed = options.seed,
+            target_ci = options.target_ci,
+            min_snapshots = options.min_snapshots,
+            convergence_filename = options.convergence_filename,
+            convergence_stride = options.convergence_stride,
+            histogram_width = options.histogram_width,
+            histogram_bins = options.histogram_bins,
+            histogram_origin = histogram_origin,
+            percentiles = percentiles,
+            read_options = read_options,
+            reread_changed = options.reread_changed
+        )
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors = True)
 
     print_info("Finished.")
 
@@ -4,7 +4,14 @@ from os.path import splitext
 import re
 from .geom.datastruct import Atom, Coordinates
 from .geom.io import GeomReadException, XYZIO, TurbomoleIO, GaussianOutputIO, ADFOutputIO
-from .nmr.datastruct import SigmaTensor, SigmaReference, TensorList, TensorList, TensorStats
-from .nmr.parsers import NMRTensorReadError, NMRFinishReadException, GaussianOutputParser, ADFOutputParser
+from .nmr.datastruct import symmetrize_tensors, calc_principal_axes, calc_tensor_descriptors, SigmaTensor, SigmaTensorView, AtomSelection, SigmaReference, TensorList, ColumnarTensorList, TensorStats
+from .nmr.parsers import NMRTensorReadError, NMRFinishReadException, GaussianOutputParser, ADFOutputParser, read_files, read_archive
+from .nmr.cache import ParseCache, file_identity, member_identity
+from .nmr.index import OutputIndex
+from .nmr.npzio import write_npz, read_npz
+from .nmr.samples import SampleStore
+from .nmr.histogram import StreamingHistograms
+from .nmr.uncertainty import naive_sem, block_sems, block_sem, statistical_inefficiency, inefficiency_sem, bootstrap_errors, calc_convergence
 from .util.elements import PeriodicTable
 from .util.units import *
+from .util.fileio import open_input, input_file, iter_archive, is_archive, is_plain_file
@@ -1,3 +1,9 @@
 import pyqmtools
-from .datastruct import SigmaTensor, SigmaReference, TensorList, TensorList, TensorStats
-from .parsers import NMRTensorReadError, NMRFinishReadException, GaussianOutputParser, ADFOutputParser
+from .datastruct import symmetrize_tensors, calc_principal_axes, calc_tensor_descriptors, SigmaTensor, SigmaTensorView, AtomSelection, SigmaReference, TensorList, ColumnarTensorList, TensorStats
+from .parsers import NMRTensorReadError, NMRFinishReadException, GaussianOutputParser, ADFOutputParser, read_files, read_archive
+from .cache import ParseCache, file_identity, member_identity
+from .index import OutputIndex
+from .npzio import write_npz, read_npz
+from .samples import SampleStore
+from .histogram import StreamingHistograms
+from .uncertainty import naive_sem, block_sems, block_sem, statistical_inefficiency, inefficiency_sem, bootstrap_errors, calc_convergence
@@ -0,0 +1,293 @@
+"""
+Persistent on-disk cache of parsed NMR tensors. The results are stored as 
+uncompressed NumPy .npz files keyed by the identity of the parsed file and by 
+the options of the parser, so unchanged outputs are not parsed again.
+"""
+import os
+import time
+import hashlib
+import zipfile
+from numpy import savez, load, array, int64
+from datastruct import TensorList, ColumnarTensorList
+
+def file_identity(
+    filename,
+    content_hash = False
+):
+    '''
+    return tuple identifying the state of file: absolute path, size and
+    modification time or, if 'content_hash' is set, SHA1 hash of the file
+    content
+    '''
+    st = os.stat(filename)
+
+    if content_hash:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                digest.update(chunk)
+        state = digest.hexdigest()
+    else:
+        state = repr(st.st_mtime)
+
+    return (os.path.abspath(filename), st.st_size, state)
+
+def member_identity(filename, member):
+    '''
+    return tuple identifying the state of 'member' (TarInfo) of tar archive 
+    'filename' like file_identity: absolute path of the member within the 
+    archive, its size and modification time
+    '''
+    return (
+        os.path.join(os.path.abspath(filename), member.name),
+        member.size,
+        repr(float(member.mtime))
+    )
+
+class ParseCache(object):
+    '''
+    cache of TensorList instances read by GaussianOutputParser and 
+    ADFOutputParser. The total size of cache directory is kept below 
+    'max_size' bytes by removing least recently used entries. The directory
+    is scanned only when the running total of its size kept by the process
+    exceeds 'max_size' or after the process stored '_rescan_fraction' of
+    'max_size' (other processes may store entries as well), not after every
+    entry
+    '''
+    # bump when the parsers change in a way that invalidates old entries
+    _version = 1
+    _suffix = '.npz'
+    _tmp_suffix = '.tmp'
+    # temporary files older than this (in seconds) were left by crashed
+    # writers and are removed
+    _stale_tmp_age = 3600
+    _rescan_fraction = 0.1
+    # eviction frees this fraction of 'max_size' below it, so that the
+    # following entries do not evict (and scan) again
+    _evict_fraction = 0.1
+    # per-process usage of cache directories: directory -> [total size,
+    # bytes stored since the last scan]
+    _usage = {}
+    _env_directory = 'PYQMTOOLS_CACHE_DIR'
+    _default_max_size = 1 << 30
+
+    def __init__(self,
+        directory = None,
+        max_size = _default_max_size,
+        content_hash = False
+    ):
+        if directory is None:
+            directory = os.environ.get(
+                self.__class__._env_directory,
+                os.path.join(os.path.expanduser('~'), '.cache', 'pyqmtools')
+            )
+
+        self.directory = directory
+        self.max_size = max_size
+        self.content_hash = content_hash
+
+    def get_key(self, parser):
+        '''
+        return cache key for the file and options of 'parser'
+        '''
+        selection = getattr(parser, 'selection', None)
+        if selection is not None:
+            selection = str(selection)
+
+        key = (
+            self.__class__._version,
+            parser.__class__.__name__,
+            file_identity(parser.filename, self.content_hash),
+            parser.shielding_type,
+            getattr(parser, 'atom_numbering', None),
+            getattr(parser, 'max_index', 0),
+            getattr(parser, 'from_cartesian', False),
+            selection
+        )
+
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + self.__class__._suffix)
+
+    def load(self, key, columnar = False):
+        '''
+        return cached TensorList (ColumnarTensorList if 'columnar' is set) or 
+        None if there is no valid entry for 'key'
+        '''
+        path = self._get_path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = load(f)
+                result = ColumnarTensorList(
+                    filename = str(data['filename']),
+                    file_type = str(data['file_type']),
+                    shielding_type = str(data['shielding_type']),
+                    capacity = data['indices'].shape[0]
+                )
+                result.append_arrays(
+                    data['indices'],
+                    data['elements'],
+                    data['eigenvalues'],
+                    data['eigenvectors']
+                )
+        except (IOError, OSError):
+            return None
+        except (KeyError, ValueError, zipfile.BadZipfile):
+            # corrupted or truncated entry is removed and parsed again
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        if not columnar:
+            result = result.to_tensor_list()
+
+        return result
+
+    def store(self, key, tens_list):
+        '''
+        store TensorList under 'key' and evict old entries if necessary
+        '''
+        if not isinstance(tens_list, ColumnarTensorList):
+            tens_list = ColumnarTensorList.from_tensor_list(tens_list)
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # may have been created by other process in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+        path = self._get_path(key)
+        # write to temporary file first, so that concurrent readers never see
+        # incomplete entry
+        tmp_path = '%s.%d%s' % (path, os.getpid(), self.__class__._tmp_suffix)
+
+        with open(tmp_path, 'wb') as f:
+            savez(
+                f,
+                indices = array(tens_list.indices, dtype = int64),
+                elements = tens_list.get_elements(),
+                eigenvalues = tens_list.eigenvalues,
+                eigenvectors = tens_list.eigenvectors,
+                filename = array(tens_list.filename),
+                file_type = array(tens_list.file_type),
+                shielding_type = array(tens_list.shielding_type)
+            )
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+
+        self._add_usage(size)
+
+    def _add_usage(self, size):
+        '''
+        add 'size' of new entry to the running total of the cache directory
+        and evict old entries if the total exceeds 'max_size'
+        '''
+        cls = self.__class__
+        usage = cls._usage.get(self.directory)
+
+        if usage is None or usage[1] > self.max_size * cls._rescan_fraction:
+            # the new entry is found by the scan
+            self.evict()
+            return
+
+        usage[0] += size
+        usage[1] += size
+        if usage[0] > self.max_size:
+            self.evict()
+
+    def _scan(self):
+        '''
+        return list of (modification time, size, path) of cache entries
+        sorted from the least recently used and total size of the directory.
+        Temporary files are counted, stale ones are removed
+        '''
+        cls = self.__class__
+        entries = []
+        total = 0
+        now = time.time()
+
+        for fn in os.listdir(self.directory):
+            is_tmp = fn.endswith(cls._tmp_suffix)
+            if not (is_tmp or fn.endswith(cls._suffix)):
+                continue
+
+            path = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            if is_tmp:
+                if now - st.st_mtime > cls._stale_tmp_age:
+                    try:
+                        os.remove(path)
+                        continue
+                    except OSError:
+                        pass
+            else:
+                entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        return (entries, total)
+
+    def evict(self):
+        '''
+        scan the cache directory and, if it does not fit 'max_size', remove
+        least recently used entries until it fits with '_evict_fraction' of
+        'max_size' to spare
+        '''
+        (entries, total) = self._scan()
+        limit = self.max_size
+        if total > self.max_size:
+            limit = self.max_size * (1.0 - self.__class__._evict_fraction)
+
+        for (mtime, size, path) in entries:
+            if total <= limit:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+        self.__class__._usage[self.directory] = [total, 0]
+
+    def read(self, parser):
+        '''
+        return TensorList for 'parser' from cache, reading the file by the 
+        parser only if there is no valid entry
+        '''
+        if getattr(parser, 'fileobj', None) is not None or \
+            not os.path.isfile(parser.filename):
+            # streams and archive members can not be identified
+            return parser._read()
+
+        key = self.get_key(parser)
+        columnar = getattr(parser, 'columnar', False)
+
+        result = self.load(key, columnar = columnar)
+        if result is None:
+            result = parser._read()
+
+            try:
+                self.store(key, result)
+            except (IOError, OSError):
+                # the cache is only an optimization, unwritable cache 
+                # directory must not break reading
+                pass
+
+        return result
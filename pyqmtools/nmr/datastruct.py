@@ -1,11 +1,144 @@
-from numpy import array, sum, dot, zeros, std, mean, sqrt
-from numpy.linalg import norm, eig
+from numpy import array, sum, dot, zeros, std, mean, sqrt, \
+    argsort, delete, unique, asarray, where, newaxis, array_equal, errstate, \
+    int32, int64, savez, load, ones, in1d, char, concatenate, sort, arange, \
+    isnan, ceil, median, empty, isfinite
+from numpy.linalg import norm, eigh
 from collections import MutableSequence
+from copy import deepcopy
+from itertools import chain, islice
+import json
+from npzio import write_npz, read_npz
+from histogram import StreamingHistograms
+from uncertainty import block_sem, inefficiency_sem, \
+    statistical_inefficiency, bootstrap_errors, calc_convergence
+
+def symmetrize_tensors(tensors):
+    '''
+    return symmetric part of a single 3 x 3 tensor or of (N x 3 x 3) stack of
+    tensors
+    '''
+    tensors = asarray(tensors, dtype = float)
+    return 0.5 * (tensors + tensors.swapaxes(-1, -2))
+
+def calc_principal_axes(tensors):
+    '''
+    diagonalize symmetric parts of (N x 3 x 3) stack of Cartesian tensors at 
+    once and return (N x 3) array of principal components sorted in ascending 
+    order and (N x 3 x 3) array of corresponding eigenvectors in rows
+    '''
+    (eigenvalues, eigenvectors) = eigh(symmetrize_tensors(tensors))
+    return (eigenvalues, eigenvectors.swapaxes(-1, -2))
+
+def calc_tensor_descriptors(eigenvalues, shift = False):
+    '''
+    return dictionary of descriptors of tensors given by (... x 3) array of
+    principal components (e.g. snapshots x atoms x 3), each descriptor is an
+    array of the leading shape:
+
+    'iso' - isotropic value
+    '11', '22', '33' - principal components ordered according to Mehring
+        (ascending for shieldings, descending for chemical shifts)
+    'span', 'skew' - Herzfeld-Berger span and skew
+    'anisotropy', 'reduced_anisotropy', 'asymmetry' - Haeberlen anisotropy,
+        reduced anisotropy and asymmetry parameter, the components are ordered
+        as |zz - iso| >= |xx - iso| >= |yy - iso|
+
+    'shift' is True for chemical shifts, False for shieldings or boolean
+    array of the leading shape for mixed data (e.g. only some nuclei
+    referenced). Skew and asymmetry of tensors with zero span (isotropic
+    tensors) are 0, so that they do not turn averages to NaN
+    '''
+    eigenvalues = asarray(eigenvalues, dtype = float)
+    shape = eigenvalues.shape[:-1]
+    shift = asarray(shift, dtype = bool)
+
+    ordered = sort(eigenvalues, axis = -1)
+    iso = eigenvalues.mean(axis = -1)
+    mehring = where(shift[..., newaxis], ordered[..., ::-1], ordered)
+
+    span = ordered[..., 2] - ordered[..., 0]
+    # deviations from the isotropic value in Haeberlen order yy, xx, zz
+    deviations = (ordered - iso[..., newaxis]).reshape(-1, 3)
+    order = argsort(abs(deviations), axis = 1, kind = 'mergesort')
+    deviations = deviations[
+        arange(deviations.shape[0])[:, newaxis],
+        order
+    ].reshape(shape + (3,))
+    reduced_anisotropy = deviations[..., 2]
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        skew = where(
+            span != 0,
+            3.0 * where(
+                shift,
+                ordered[..., 1] - iso,
+                iso - ordered[..., 1]
+            ) / span,
+            0.0
+        )
+        asymmetry = where(
+            reduced_anisotropy != 0,
+            (deviations[..., 0] - deviations[..., 1]) / reduced_anisotropy,
+            0.0
+        )
+
+    return {
+        'iso' : iso,
+        '11' : mehring[..., 0],
+        '22' : mehring[..., 1],
+        '33' : mehring[..., 2],
+        'span' : span,
+        'skew' : skew,
+        'anisotropy' : 1.5 * reduced_anisotropy,
+        'reduced_anisotropy' : reduced_anisotropy,
+        'asymmetry' : asymmetry
+    }
+
+def _check_element(arg):
+    '''
+    validate element symbol and return it in capitalized form
+    '''
+    if (type(arg) is str) and (len(arg) < 3):
+        return arg.capitalize()
+    else:
+        raise ValueError(
+            "Invalid argument for element symbol %s" % repr(arg)
+        )
+
+# validated element symbols indexed by the raw symbols they were made from, 
+# all tensors of the same element share single interned string
+_element_symbols = {}
+
+def _intern_element(arg):
+    '''
+    return validated and interned element symbol, repeated symbols are looked
+    up without validation
+    '''
+    if type(arg) is str:
+        try:
+            return _element_symbols[arg]
+        except KeyError:
+            result = intern(_check_element(arg))
+            _element_symbols[arg] = result
+            return result
+
+    return _check_element(arg)
 
 class SigmaTensor(object):
     '''
     TODO:
     '''
+    # no per-instance __dict__, the Cartesian representation and symmetric 
+    # tensor are allocated only when they are first accessed
+    __slots__ = (
+        'shielding_type',
+        'eigenvalues',
+        'eigenvectors',
+        'index',
+        '_element',
+        '_cartesian_rep',
+        '_symm_tensor'
+    )
 
     _index_format = "%6d"
     _element_format = "%3s"
@@ -19,8 +152,6 @@ class SigmaTensor(object):
     ):
 
         self.shielding_type = shielding_type
-        self.cartesian_rep = zeros((3,3))
-        self.symm_tensor = zeros((3,3))
 
         self.eigenvalues = zeros(3)
         self.eigenvectors = zeros((3,3))
@@ -28,6 +159,16 @@ class SigmaTensor(object):
         self.element = element
         self.index = index 
 
+    def __getstate__(self):
+        return dict(
+            (k, getattr(self, k)) for k in SigmaTensor.__slots__ 
+                if hasattr(self, k)
+        )
+
+    def __setstate__(self, state):
+        for (k, v) in state.items():
+            setattr(self, k, v)
+
     def __eq__(self, other):
         return self.index == other.index and self.element == other.element
 
@@ -47,24 +188,13 @@ class SigmaTensor(object):
         return self.index >= other.index
 
     def _calc_symmetric_tensor(self):
-        symm_elem = 0.0
-        for i in xrange(3):
-            for j in xrange(3):
-                if i == j:
-                    self.symm_tensor[i][j] == self.cartesian_rep 
-                else:
-                    symm_element = (self.cartesian_rep[i][j] \
-                        + self.cartesian_rep[j][i]) * 0.5
-
-                    self.symm_tensor[i][j] = symm_element
-                    self.symm_tensor[j][i] = symm_element
+        self.symm_tensor = symmetrize_tensors(self.cartesian_rep)
 
     def _calc_eigvals_eigvecs(self):
-        (vals, vecs) = eig(self.symm_tensor)
-        self.eigenvalues = vals
-        # transpose eigenvectors to obtain them in row form
-        # eig returns them in column matrix
-        self.eigenvectors = vecs.T
+        # principal components in ascending order, eigenvectors in rows
+        (vals, vecs) = calc_principal_axes(self.symm_tensor[newaxis])
+        self.eigenvalues = vals[0]
+        self.eigenvectors = vecs[0]
         
 
 
@@ -84,15 +214,30 @@ class SigmaTensor(object):
         return message
 
     def get_element(self):
-        return self.__element
+        return self._element
 
     def set_element(self, arg):
-        if (type(arg) is str) and (len(arg) < 3):
-            self.__element = arg.capitalize()
-        else:
-            raise ValueError(
-                "Invalid argument for element symbol %s" % repr(arg)
-            )
+        self._element = _intern_element(arg)
+
+    def get_cartesian_rep(self):
+        try:
+            return self._cartesian_rep
+        except AttributeError:
+            self._cartesian_rep = zeros((3,3))
+            return self._cartesian_rep
+
+    def set_cartesian_rep(self, arg):
+        self._cartesian_rep = arg
+
+    def get_symm_tensor(self):
+        try:
+            return self._symm_tensor
+        except AttributeError:
+            self._symm_tensor = zeros((3,3))
+            return self._symm_tensor
+
+    def set_symm_tensor(self, arg):
+        self._symm_tensor = arg
 
     def write_to_file(self, 
         f, 
@@ -151,6 +296,197 @@ out the principal axis system'''
     
     
     element = property(get_element, set_element)
+    cartesian_rep = property(get_cartesian_rep, set_cartesian_rep)
+    symm_tensor = property(get_symm_tensor, set_symm_tensor)
+
+def _restore_tensor(state):
+    '''
+    create SigmaTensor from the state returned by its __getstate__
+    '''
+    tensor = SigmaTensor.__new__(SigmaTensor)
+    tensor.__setstate__(state)
+    return tensor
+
+class SigmaTensorView(SigmaTensor):
+    '''
+    lightweight SigmaTensor proxy for a single row of ColumnarTensorList.
+    Attribute access reads and writes the columns of the owning list directly,
+    so the view is only valid until the rows of the list are reordered
+    '''
+    __slots__ = ('_owner', '_row')
+
+    def __init__(self, owner, row):
+        self._owner = owner
+        self._row = row
+
+    def __reduce_ex__(self, protocol):
+        # pickled and copied views become standalone tensors, not copies of 
+        # the whole owning list
+        return (_restore_tensor, (self.detach().__getstate__(),))
+
+    def get_index(self):
+        return int(self._owner._indices[self._row])
+
+    def set_index(self, arg):
+        self._owner._indices[self._row] = arg
+
+    def get_element(self):
+        return self._owner._element_symbols[
+            self._owner._element_codes[self._row]
+        ]
+
+    def set_element(self, arg):
+        self._owner._element_codes[self._row] = \
+            self._owner.get_element_code(arg)
+
+    def get_eigenvalues(self):
+        return self._owner._eigenvalues[self._row]
+
+    def set_eigenvalues(self, arg):
+        self._owner._eigenvalues[self._row] = arg
+
+    def get_eigenvectors(self):
+        return self._owner._eigenvectors[self._row]
+
+    def set_eigenvectors(self, arg):
+        self._owner._eigenvectors[self._row] = arg
+
+    def get_shielding_type(self):
+        return self._owner.shielding_type
+
+    def detach(self):
+        '''
+        return standalone SigmaTensor holding a copy of the row data
+        '''
+        result = SigmaTensor(
+            element = self.element,
+            index = self.index,
+            shielding_type = self.shielding_type
+        )
+        result.eigenvalues = self.eigenvalues.copy()
+        result.eigenvectors = self.eigenvectors.copy()
+        return result
+
+    index = property(get_index, set_index)
+    element = property(get_element, set_element)
+    eigenvalues = property(get_eigenvalues, set_eigenvalues)
+    eigenvectors = property(get_eigenvectors, set_eigenvectors)
+    shielding_type = property(get_shielding_type)
+
+class AtomSelection(object):
+    '''
+    selection of atoms by element symbols, atom indices and ranges of atom 
+    indices. An atom is selected when its element is among the selected 
+    elements and its index is among the selected indices or ranges, an empty 
+    criterion matches any atom
+    '''
+
+    def __init__(self,
+        elements = [],
+        indices = [],
+        ranges = []
+    ):
+        self.elements = set(_check_element(e) for e in elements)
+        self.indices = set(indices)
+        # list of (first, last) tuples, both ends are included
+        self.ranges = list(ranges)
+
+    def __str__(self):
+        items = sorted(self.elements) + [str(i) for i in sorted(self.indices)]
+        items += ['%d-%d' % r for r in self.ranges]
+        return ','.join(items)
+
+    def has_index_criterion(self):
+        return len(self.indices) > 0 or len(self.ranges) > 0
+
+    def is_selected(self, index, element):
+        if len(self.elements) > 0 and element.capitalize() not in self.elements:
+            return False
+
+        if self.has_index_criterion():
+            if index in self.indices:
+                return True
+
+            for (first, last) in self.ranges:
+                if first <= index <= last:
+                    return True
+
+            return False
+
+        return True
+
+    def get_mask(self, indices, elements):
+        '''
+        vectorized version of 'is_selected', returns boolean array for arrays 
+        of atom indices and element symbols
+        '''
+        indices = asarray(indices)
+        mask = ones(indices.shape[0], dtype = bool)
+
+        if len(self.elements) > 0:
+            mask &= in1d(
+                char.capitalize(asarray(elements, dtype = 'S2')),
+                array(sorted(self.elements), dtype = 'S2')
+            )
+
+        if self.has_index_criterion():
+            index_mask = in1d(indices, array(sorted(self.indices), dtype = int64))
+            for (first, last) in self.ranges:
+                index_mask |= (indices >= first) & (indices <= last)
+
+            mask &= index_mask
+
+        return mask
+
+    def get_index_set(self):
+        '''
+        return set of all selected indices or None when the selection is not
+        restricted by indices
+        '''
+        if not self.has_index_criterion():
+            return None
+
+        result = set(self.indices)
+        for (first, last) in self.ranges:
+            result.update(xrange(first, last + 1))
+
+        return result
+
+    @classmethod
+    def from_string(cls, arg):
+        '''
+        create selection from comma-separated list of element symbols, atom 
+        indices and inclusive ranges of indices, e.g. 'C,N,1-50,72'
+        '''
+        elements = []
+        indices = []
+        ranges = []
+
+        for item in arg.split(','):
+            item = item.strip()
+            if len(item) == 0:
+                continue
+
+            try:
+                if item.isalpha():
+                    elements.append(item)
+                elif '-' in item:
+                    (first, last) = [int(i) for i in item.split('-')]
+                    if first > last:
+                        raise ValueError
+                    ranges.append((first, last))
+                else:
+                    indices.append(int(item))
+            except ValueError:
+                raise ValueError(
+                    "Invalid atom selection item \"%s\"" % item
+                )
+
+        return cls(
+            elements = elements,
+            indices = indices,
+            ranges = ranges
+        )
 
 class SigmaReference():
     '''
@@ -197,12 +533,90 @@ class SigmaReference():
                 self.refs[tensor.element][0] - tensor.eigenvalues + \
                 self.refs[tensor.element][1]
 
-    def transform_tensor_list(self, tens_list):
+    def get_lookup_vectors(self, element_symbols):
+        '''
+        build arrays of reference shieldings, reference shifts and a mask of
+        referenced elements, indexed in the same way as 'element_symbols'
+        '''
+        sigma = zeros(len(element_symbols))
+        delta = zeros(len(element_symbols))
+        mask = zeros(len(element_symbols), dtype = bool)
+
+        for (i, e) in enumerate(element_symbols):
+            if e in self.refs:
+                (sigma[i], delta[i]) = self.refs[e]
+                mask[i] = True
+
+        return (sigma, delta, mask)
+
+    def transform_arrays(self, 
+        element_symbols,
+        element_codes, 
+        eigenvalues,
+        in_place = True
+    ):
+        '''
+        convert (N x 3) array of shielding eigenvalues to chemical shifts in 
+        one broadcast operation. 'element_codes' index into the sequence of
+        'element_symbols', values of unreferenced elements are left untouched
+        '''
+        (sigma, delta, mask) = self.get_lookup_vectors(element_symbols)
+
+        # delta_i = (sigma_ref + delta_ref) - sigma_i for referenced elements,
+        # unreferenced rows get multiplied by 1 and shifted by 0
+        offset = where(mask, sigma + delta, 0.0)[element_codes]
+        factor = where(mask, -1.0, 1.0)[element_codes]
+
+        if not in_place:
+            eigenvalues = eigenvalues.copy()
+
+        eigenvalues *= factor[:, newaxis]
+        eigenvalues += offset[:, newaxis]
+
+        return eigenvalues
+
+    def transform_tensors(self, tensors):
+        '''
+        generator referencing tensors from any iterable one by one
+        '''
+        for t in tensors:
+            self.transform_tensor(t)
+            yield t
+
+    def transform_tensor_list(self, tens_list, in_place = True):
+        '''
+        reference all tensors in TensorList. When 'in_place' is False, the
+        referenced copy of the list is returned and the original is kept 
+        intact
+        '''
         if isinstance(tens_list, TensorList):
+            if not in_place:
+                tens_list = deepcopy(tens_list)
+
             if tens_list.referenced == False:
-                for d in tens_list:
-                    self.transform_tensor(d)
+                if isinstance(tens_list, ColumnarTensorList):
+                    self.transform_arrays(
+                        tens_list.element_symbols,
+                        tens_list.element_codes,
+                        tens_list.eigenvalues
+                    )
+
+                elif len(tens_list) > 0:
+                    symbols = sorted(set(d.element for d in tens_list))
+                    lookup = dict((e, i) for (i, e) in enumerate(symbols))
+                    eigenvalues = self.transform_arrays(
+                        symbols,
+                        array([lookup[d.element] for d in tens_list]),
+                        array([d.eigenvalues for d in tens_list], dtype = float)
+                    )
+
+                    for (d, v) in zip(tens_list, eigenvalues):
+                        if d.element in self.refs:
+                            d.eigenvalues = v
+
                 tens_list.referenced = True
+
+            return tens_list
         else:
             raise TypeError(
                 "Argument must be of type \'TensorList\'"
@@ -229,10 +643,60 @@ class SigmaReference():
                 raise ValueError("Invalid record: \"%s\"" % line)
 
 
+def _format_tensors(
+    indices,
+    elements,
+    eigenvalues,
+    eigenvectors = None,
+    level = 1
+):
+    '''
+    return text of tensors given as arrays in exactly the same layout as 
+    written by SigmaTensor.write_to_file, formatted by single '%' operation. 
+    Eigenvectors are needed only for 'level = 3'
+    '''
+    line_format = ' '.join(
+        [
+            SigmaTensor._index_format,
+            SigmaTensor._element_format,
+            SigmaTensor._eigenvalue_format
+        ]
+    )
+    eigenvalues = asarray(eigenvalues, dtype = float).reshape(-1, 3)
+    columns = [
+        list(indices),
+        list(elements),
+        eigenvalues.mean(axis = 1).tolist()
+    ]
+
+    if level > 1:
+        line_format += ' '.join([SigmaTensor._eigenvalue_format] * 3)
+        columns.extend(eigenvalues.T.tolist())
+
+    line_format += '\n'
+
+    if level == 3:
+        line_format = ''.join(
+            [
+                line_format,
+                "# Principal axis system (eigenvectors in rows):\n",
+                ("    " + SigmaTensor._eigenvector_format * 3 + '\n') * 3,
+                '#' * 78 + '\n'
+            ]
+        )
+        columns.extend(
+            asarray(eigenvectors, dtype = float).reshape(-1, 9).T.tolist()
+        )
+
+    return (line_format * len(columns[0])) % \
+        tuple(chain.from_iterable(zip(*columns)))
+
 class TensorList(MutableSequence):
     '''
     TODO:
     '''
+    # number of tensors formatted at once when writing text output
+    _write_chunk_size = 4096
 
     def __init__(self, 
         filename = "", 
@@ -287,10 +751,129 @@ class TensorList(MutableSequence):
     def sort(self):
         self.data.sort()
 
+    def get_descriptors(self, shift = False):
+        '''
+        return dictionary of arrays of descriptors (isotropic value, Mehring
+        principal components, Herzfeld-Berger span and skew and Haeberlen
+        anisotropy and asymmetry) of all the tensors, see 
+        calc_tensor_descriptors
+        '''
+        eigenvalues = array(
+            [t.eigenvalues for t in self.data], 
+            dtype = float
+        ).reshape(-1, 3)
+        return calc_tensor_descriptors(eigenvalues, shift)
+
     def write_to_file(self,
         f,
         level = 1,
         reference = None
+    ):
+        self.write_header(
+            f,
+            level = level,
+            reference = reference
+        )
+
+        if reference is not None and isinstance(reference, SigmaReference):
+            reference.transform_tensor_list(self)
+
+        self._write_data(f, level)
+
+    def write_tensors(self,
+        f,
+        tensors,
+        level = 1,
+        reference = None
+    ):
+        '''
+        write header describing this list followed by tensors taken from any
+        iterable (e.g. parser's iter_tensors), so the output can be written
+        while the tensors are still being read
+        '''
+        self.write_header(
+            f,
+            level = level,
+            reference = reference
+        )
+
+        if reference is not None and isinstance(reference, SigmaReference):
+            tensors = reference.transform_tensors(tensors)
+
+        self._write_iterable(f, tensors, level)
+
+    def _write_data(self, f, level):
+        self._write_iterable(f, self, level)
+
+    def _write_iterable(self, f, tensors, level):
+        '''
+        write tensors from any iterable in chunks formatted at once
+        '''
+        tensors = iter(tensors)
+
+        while True:
+            chunk = list(islice(tensors, self.__class__._write_chunk_size))
+            if len(chunk) == 0:
+                break
+
+            eigenvectors = None
+            if level == 3:
+                eigenvectors = [t.eigenvectors for t in chunk]
+
+            f.write(
+                _format_tensors(
+                    [t.index for t in chunk],
+                    [t.element for t in chunk],
+                    [t.eigenvalues for t in chunk],
+                    eigenvectors,
+                    level = level
+                )
+            )
+
+    def write_binary(self,
+        f,
+        reference = None
+    ):
+        '''
+        write the tensors in full precision to binary file (uncompressed 
+        NumPy .npz archive) holding arrays 'indices', 'elements', 
+        'eigenvalues' and 'eigenvectors' along with JSON 'header' describing
+        the list. The file can be read back by ColumnarTensorList.read_binary
+        '''
+        header = {
+            'content' : 'TensorList',
+            'filename' : self.filename,
+            'file_type' : self.file_type,
+            'shielding_type' : self.shielding_type,
+            'references' : {}
+        }
+
+        if reference is not None and isinstance(reference, SigmaReference):
+            reference.transform_tensor_list(self)
+            header['references'] = dict(
+                (r, list(reference.refs[r])) for r in reference.refs
+            )
+
+        header['referenced'] = self.referenced
+
+        if isinstance(self, ColumnarTensorList):
+            tens_list = self
+        else:
+            tens_list = ColumnarTensorList.from_tensor_list(self)
+
+        write_npz(
+            f,
+            header,
+            indices = tens_list.indices,
+            elements = tens_list.get_elements(),
+            eigenvalues = tens_list.eigenvalues,
+            eigenvectors = tens_list.eigenvectors
+        )
+
+    def write_header(self,
+        f,
+        level = 1,
+        reference = None
     ):
         if level < 0 or level > 3:
             raise TypeError("Invalid verbosity level, should be 1 to 3")
@@ -318,8 +901,6 @@ class TensorList(MutableSequence):
                     ]
                 )
 
-            reference.transform_tensor_list(self)
-
         f.write(file_info)
 
         list_info = "# list of %s shielding tensor parameters\n" % \
@@ -359,19 +940,376 @@ class TensorList(MutableSequence):
             header
         )
 
-        for d in self.data:
-            d.write_to_file(
-                f,
-                level = level
+    shielding_type = property(get_shielding_type, set_shielding_type)
+
+
+class ColumnarTensorList(TensorList):
+    '''
+    TensorList storing the tensor data in contiguous arrays (atom indices,
+    element codes, eigenvalues and eigenvectors) instead of one SigmaTensor 
+    instance per nucleus. Item access returns SigmaTensorView proxies so the 
+    per-tensor interface keeps working, while bulk operations can work on the 
+    whole arrays at once
+    '''
+
+    _min_capacity = 16
+
+    def __init__(self, 
+        filename = "", 
+        file_type = "", 
+        shielding_type = 'total',
+        capacity = 0
+    ):
+        # number of valid rows, the arrays are over-allocated to make
+        # appending cheap
+        self._size = 0
+        # element codes are indices to this table of element symbols
+        self._element_symbols = []
+        self._element_codes_lookup = {}
+        self._allocate(max(capacity, self.__class__._min_capacity))
+
+        self.filename = filename
+        self.file_type = file_type
+        self.shielding_type = shielding_type
+        self.referenced = False
+
+    def _allocate(self, capacity):
+        indices = zeros(capacity, dtype = int64)
+        element_codes = zeros(capacity, dtype = int32)
+        eigenvalues = zeros((capacity, 3))
+        eigenvectors = zeros((capacity, 3, 3))
+
+        if self._size > 0:
+            indices[:self._size] = self._indices[:self._size]
+            element_codes[:self._size] = self._element_codes[:self._size]
+            eigenvalues[:self._size] = self._eigenvalues[:self._size]
+            eigenvectors[:self._size] = self._eigenvectors[:self._size]
+
+        self._indices = indices
+        self._element_codes = element_codes
+        self._eigenvalues = eigenvalues
+        self._eigenvectors = eigenvectors
+
+    def __getstate__(self):
+        # the unused capacity of the arrays is not pickled
+        state = self.__dict__.copy()
+        for k in ('_indices', '_element_codes', '_eigenvalues', '_eigenvectors'):
+            state[k] = state[k][:self._size].copy()
+
+        return state
+
+    def _reserve(self, size):
+        if size > self._indices.shape[0]:
+            self._allocate(max(size, 2 * self._indices.shape[0]))
+
+    def _check_row(self, index):
+        if index < 0:
+            index += self._size
+
+        if index < 0 or index >= self._size:
+            raise IndexError("list index out of range")
+
+        return index
+
+    def _set_row(self, row, value):
+        self._indices[row] = value.index
+        self._element_codes[row] = self.get_element_code(value.element)
+        self._eigenvalues[row] = value.eigenvalues
+        self._eigenvectors[row] = value.eigenvectors
+
+    def get_element_code(self, element):
+        '''
+        return the code of element symbol, registering new symbols on the fly
+        '''
+        element = _check_element(element)
+
+        if element not in self._element_codes_lookup:
+            self._element_codes_lookup[element] = len(self._element_symbols)
+            self._element_symbols.append(element)
+
+        return self._element_codes_lookup[element]
+
+    def _get_codes(self, elements):
+        '''
+        return array of codes of all element symbols in 'elements'
+        '''
+        (symbols, inverse) = unique(
+            asarray(elements, dtype = 'S2'), 
+            return_inverse = True
+        )
+        codes = array(
+            [self.get_element_code(str(e)) for e in symbols], 
+            dtype = int32
+        )
+
+        return codes[inverse]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            result = ColumnarTensorList(
+                filename = self.filename,
+                file_type = self.file_type,
+                shielding_type = self.shielding_type
+            )
+            result.append_arrays(
+                self.indices[index],
+                self.get_elements()[index],
+                self.eigenvalues[index],
+                self.eigenvectors[index]
             )
+            result.referenced = self.referenced
+            return result
 
-    shielding_type = property(get_shielding_type, set_shielding_type)
+        return SigmaTensorView(self, self._check_row(index))
+
+    def __setitem__(self, index, value):
+        self.check_type(value)
+        self._set_row(self._check_row(index), value)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            rows = range(*index.indices(self._size))
+        else:
+            rows = self._check_row(index)
+
+        indices = delete(self.indices, rows)
+        element_codes = delete(self.element_codes, rows)
+        eigenvalues = delete(self.eigenvalues, rows, axis = 0)
+        eigenvectors = delete(self.eigenvectors, rows, axis = 0)
+
+        self._size = indices.shape[0]
+        self._indices[:self._size] = indices
+        self._element_codes[:self._size] = element_codes
+        self._eigenvalues[:self._size] = eigenvalues
+        self._eigenvectors[:self._size] = eigenvectors
+
+    def __len__(self):
+        return self._size
+
+    def set_shielding_type(self, arg):
+        self._TensorList__shielding_type = arg
+
+    def insert(self, index, value):
+        self.check_type(value)
+        if index < 0:
+            index = max(index + self._size, 0)
+        index = min(index, self._size)
+
+        self._reserve(self._size + 1)
+        for column in (
+            self._indices, 
+            self._element_codes, 
+            self._eigenvalues, 
+            self._eigenvectors
+        ):
+            column[index + 1:self._size + 1] = column[index:self._size].copy()
+
+        self._size += 1
+        self._set_row(index, value)
+
+    def append(self, value):
+        self.check_type(value)
+        self._reserve(self._size + 1)
+        self._size += 1
+        self._set_row(self._size - 1, value)
+
+    def append_arrays(self,
+        indices,
+        elements,
+        eigenvalues,
+        eigenvectors = None
+    ):
+        '''
+        append a whole batch of tensors given as arrays of atom indices, 
+        element symbols, eigenvalues (N x 3) and optionally eigenvectors 
+        (N x 3 x 3)
+        '''
+        n = len(indices)
+        begin = self._size
+        end = begin + n
+        self._reserve(end)
+
+        self._indices[begin:end] = indices
+        if n > 0:
+            self._element_codes[begin:end] = self._get_codes(elements)
+        self._eigenvalues[begin:end] = eigenvalues
+        if eigenvectors is not None:
+            self._eigenvectors[begin:end] = eigenvectors
+        else:
+            self._eigenvectors[begin:end] = 0.0
+
+        self._size = end
+
+    def _write_data(self, f, level):
+        elements = self.get_elements().tolist()
+        chunk_size = self.__class__._write_chunk_size
+
+        for begin in xrange(0, self._size, chunk_size):
+            end = begin + chunk_size
+            f.write(
+                _format_tensors(
+                    self.indices[begin:end].tolist(),
+                    elements[begin:end],
+                    self.eigenvalues[begin:end],
+                    self.eigenvectors[begin:end],
+                    level = level
+                )
+            )
+
+    def sort(self):
+        order = argsort(self.indices, kind = 'mergesort')
+
+        self._indices[:self._size] = self.indices[order]
+        self._element_codes[:self._size] = self.element_codes[order]
+        self._eigenvalues[:self._size] = self.eigenvalues[order]
+        self._eigenvectors[:self._size] = self.eigenvectors[order]
+
+    def get_descriptors(self, shift = False):
+        return calc_tensor_descriptors(self.eigenvalues, shift)
+
+    def get_indices(self):
+        return self._indices[:self._size]
+
+    def get_element_codes(self):
+        return self._element_codes[:self._size]
+
+    def get_element_symbols(self):
+        return list(self._element_symbols)
+
+    def get_eigenvalues(self):
+        return self._eigenvalues[:self._size]
+
+    def get_eigenvectors(self):
+        return self._eigenvectors[:self._size]
+
+    def get_elements(self):
+        '''
+        return array of element symbols of all tensors
+        '''
+        if self._size == 0:
+            return array([], dtype = 'S2')
+
+        return array(self._element_symbols, dtype = 'S2')[self.element_codes]
+
+    def to_tensor_list(self):
+        '''
+        create plain TensorList holding standalone copies of the tensors
+        '''
+        result = TensorList(
+            filename = self.filename,
+            file_type = self.file_type,
+            shielding_type = self.shielding_type
+        )
+
+        for t in self:
+            result.append(t.detach())
+
+        result.referenced = self.referenced
+        return result
+
+    @classmethod
+    def from_tensor_list(cls, tens_list):
+        '''
+        create columnar copy of any sequence of SigmaTensor instances
+        '''
+        result = cls(
+            filename = getattr(tens_list, 'filename', ''),
+            file_type = getattr(tens_list, 'file_type', ''),
+            shielding_type = getattr(tens_list, 'shielding_type', 'total'),
+            capacity = len(tens_list)
+        )
+
+        for t in tens_list:
+            result.append(t)
+
+        result.referenced = getattr(tens_list, 'referenced', False)
+        return result
+
+    @classmethod
+    def read_binary(cls, filename, mmap = False):
+        '''
+        create ColumnarTensorList from binary file written by 'write_binary'.
+        If 'mmap' is set, eigenvalues and eigenvectors are not read into 
+        memory but mapped from the file (copy-on-write, the file is never 
+        modified)
+        '''
+        (header, arrays) = read_npz(filename, mmap = mmap)
+
+        if header.get('content') != 'TensorList':
+            raise ValueError(
+                "File \"%s\" does not contain tensor list" % filename
+            )
+
+        result = cls(
+            filename = str(header['filename']),
+            file_type = str(header['file_type']),
+            shielding_type = str(header['shielding_type'])
+        )
+        n = arrays['indices'].shape[0]
+
+        if mmap:
+            # adopt the mapped arrays as the storage
+            result._indices = arrays['indices']
+            result._element_codes = zeros(n, dtype = int32)
+            if n > 0:
+                result._element_codes[:] = result._get_codes(
+                    arrays['elements']
+                )
+            result._eigenvalues = arrays['eigenvalues']
+            result._eigenvectors = arrays['eigenvectors']
+            result._size = n
+        else:
+            result._reserve(n)
+            result.append_arrays(
+                arrays['indices'],
+                arrays['elements'],
+                arrays['eigenvalues'],
+                arrays['eigenvectors']
+            )
+
+        result.referenced = header['referenced']
+        return result
+
+    indices = property(get_indices)
+    element_codes = property(get_element_codes)
+    element_symbols = property(get_element_symbols)
+    eigenvalues = property(get_eigenvalues)
+    eigenvectors = property(get_eigenvectors)
+    shielding_type = property(
+        TensorList.get_shielding_type, 
+        set_shielding_type
+    )
 
     
 class TensorStats(object):
     """
-    class holding multiple instances of SigmaTensor for single atom.
-    useful for calculating statistics from multiple calculations
+    class accumulating statistics of SigmaTensor values for each atom over
+    multiple calculations. Only the running count, mean and sum of squared 
+    deviations (Welford's algorithm) of the isotropic value, of the three 
+    principal components and of the span, skew, anisotropy and asymmetry 
+    are kept per atom, so the memory does not grow with the number of 
+    samples. Values of atoms with elements in 'shift_elements' (e.g. those 
+    referenced) are treated as chemical shifts, the others as shieldings, 
+    which decides the ordering of principal components and the sign of skew. 
+    The tensors themselves are stored only when 'keep_samples' is set, values
+    of whole snapshots can be also appended to on-disk SampleStore given as 
+    'sample_store'. 'read_options' is JSON-serializable dictionary of the
+    options the files were read with (e.g. atom selection), which is kept in
+    the state, so that the statistics are not resumed with other ones.
+
+    Standard errors of the mean assume independent samples unless other 
+    'error_method' is set: 'block' (blocking transformation), 'inefficiency'
+    (correction by statistical inefficiency) or 'bootstrap' (moving block
+    bootstrap with blocks as long as the median statistical inefficiency of
+    isotropic values). These methods use all the snapshots in the sample 
+    store, in the order they were appended.
+
+    When 'histogram_width' is set, histograms of isotropic values of every
+    atom with 'histogram_bins' bins of that width are kept as well, from which
+    medians and other percentiles are obtained without storing the samples.
+    The bins start at global bin index 'histogram_origin' for all the atoms
+    if it is given, so that the histograms of different runs merge exactly,
+    see StreamingHistograms
     """
     _stat_header = "#%9s %6s %8s %8s %18s %20s \n" %(
         "Atom",
@@ -382,17 +1320,122 @@ class TensorStats(object):
         "95% conf. int. (+/-)"
     )
     _stat_line_fmt = "%6d %2s %6d %8.3f %8.3f %18.3f %20.3f\n"
+    # isotropic value followed by the three principal components and the
+    # descriptors of calc_tensor_descriptors
+    _component_names = (
+        'iso', 
+        '11', 
+        '22', 
+        '33', 
+        'span', 
+        'skew', 
+        'anisotropy', 
+        'reduced_anisotropy', 
+        'asymmetry'
+    )
+    _n_components = len(_component_names)
+    _confidence_factor = 1.96
+    _confidence_level = 0.95
+    _error_methods = ('naive', 'block', 'inefficiency', 'bootstrap')
+    _bootstrap_resamples = 1000
+    # bootstrap intervals are reproducible
+    _bootstrap_seed = 0
+    # relative growth of the number of samples between convergence checks
+    # by error methods other than naive
+    _convergence_check_growth = 0.1
+    # approximate size in bytes of samples read from the sample store at once
+    _sample_chunk_bytes = 1 << 27
+    _min_capacity = 16
+
     def __init__(self,
         filenames = [],
         file_type = '',
-        shield_type = 'total'
+        shield_type = 'total',
+        keep_samples = False,
+        sample_store = None,
+        shift_elements = (),
+        error_method = 'naive',
+        histogram_width = None,
+        histogram_bins = 200,
+        histogram_origin = None,
+        read_options = None
     ):
         self.filenames = filenames
         self.file_type = file_type
         self.shield_type = shield_type
+        self.keep_samples = keep_samples
+        self.sample_store = sample_store
+        self.shift_elements = sorted(
+            _intern_element(e) for e in shift_elements
+        )
+        if error_method not in self.__class__._error_methods:
+            raise ValueError(
+                "Unknown error estimation method \"%s\"" % error_method
+            )
+        self.error_method = error_method
+        # number of samples at which convergence is checked by 'error_method'
+        self._next_convergence_check = 0
+        self.read_options = read_options
+        # identities (path, size, modification time) of files already added
+        self.ingested = set()
+        self._ingested_paths = set()
+        # raw samples, filled only when 'keep_samples' is True
         self.data = {}
         self.stats = {}
-        
+
+        self.histograms = None
+        if histogram_width is not None:
+            self.histograms = StreamingHistograms(
+                histogram_width,
+                n_bins = histogram_bins,
+                origin = histogram_origin
+            )
+
+        # atom index -> row of accumulator arrays
+        self._rows = {}
+        self._elements = []
+        self._allocate(self.__class__._min_capacity)
+        # row mapping of the last added list, consecutive snapshots usually
+        # contain the same atoms in the same order
+        self._last_indices = None
+        self._last_elements = None
+        self._last_rows = None
+
+    def _allocate(self, capacity):
+        count = zeros(capacity, dtype = int64)
+        mean = zeros((capacity, self.__class__._n_components))
+        m2 = zeros((capacity, self.__class__._n_components))
+
+        n = len(self._rows)
+        if n > 0:
+            count[:n] = self._count[:n]
+            mean[:n] = self._mean[:n]
+            m2[:n] = self._m2[:n]
+
+        self._count = count
+        self._mean = mean
+        self._m2 = m2
+
+        if self.histograms is not None:
+            self.histograms.reserve(capacity)
+
+    def _get_row(self, index, element):
+        if index in self._rows:
+            row = self._rows[index]
+            if element != self._elements[row]:
+                raise ValueError(
+                    "Element mismatch between tensors"
+                )
+        else:
+            row = len(self._rows)
+            if row >= self._count.shape[0]:
+                self._allocate(2 * self._count.shape[0])
+
+            self._rows[index] = row
+            self._elements.append(element)
+
+        return row
+
     def __getitem__(self, index):
         return self.data[index]
 
@@ -404,32 +1447,663 @@ class TensorStats(object):
         del self.data[index]
 
     def __len__(self):
-        return len(self.data)
+        return len(self._rows)
     
     def check_type(self, v):
         if not isinstance(v, SigmaTensor):
             raise TypeError("unsupported type %s" % type(v))
-            
+
+    def _keep_sample(self, tensor):
+        if isinstance(tensor, SigmaTensorView):
+            tensor = tensor.detach()
+
+        if tensor.index in self.data:
+            self.data[tensor.index].append(tensor)
+        else:
+            self.data[tensor.index] = [tensor]
+
+    def _update(self, rows, values):
+        '''
+        Welford update of accumulators in 'rows' (which must be unique) with 
+        (rows x components) array of new values
+        '''
+        self._count[rows] += 1
+        delta = values - self._mean[rows]
+        self._mean[rows] += delta / self._count[rows][:, newaxis]
+        self._m2[rows] += delta * (values - self._mean[rows])
+
+        if self.histograms is not None:
+            self.histograms.update(rows, values[:, 0])
+
+    def _get_values(self, eigenvalues, elements):
+        '''
+        return (N x components) array of values of tensors given by (N x 3)
+        eigenvalues and element symbols
+        '''
+        if len(self.shift_elements) > 0:
+            shift = in1d(elements, self.shift_elements)
+        else:
+            shift = False
+
+        descriptors = calc_tensor_descriptors(eigenvalues, shift)
+
+        values = zeros((eigenvalues.shape[0], self.__class__._n_components))
+        for (k, name) in enumerate(self.__class__._component_names):
+            values[:, k] = descriptors[name]
+        return values
+
+    @classmethod
+    def get_component_names(cls):
+        return list(cls._component_names)
+
+    def get_component(self, name):
+        '''
+        return position of component 'name' in the arrays of statistics
+        '''
+        try:
+            return self.__class__._component_names.index(name)
+        except ValueError:
+            raise ValueError("Unknown component \"%s\"" % name)
+
     def add_tensor(self, tensor):
         self.check_type(tensor)
-        if tensor.index in self.data:
-            if tensor.element == self.data[tensor.index][-1].element:
-                self.data[tensor.index].append(
-                    tensor
+        row = self._get_row(tensor.index, tensor.element)
+        self._update(
+            [row],
+            self._get_values(
+                asarray(tensor.eigenvalues, dtype = float).reshape(1, 3),
+                array([tensor.element], dtype = 'S2')
+            )
+        )
+
+        if self.keep_samples:
+            self._keep_sample(tensor)
+
+    def add_arrays(self, indices, elements, eigenvalues, label = ''):
+        '''
+        add a whole snapshot given as arrays of atom indices, element symbols 
+        and (N x 3) eigenvalues. The snapshot is also appended to sample 
+        store (if there is one) under 'label'
+        '''
+        store = self.sample_store
+        # checked before the accumulators are touched
+        if store is not None and store.components is not None and \
+            list(store.components) != list(self.__class__._component_names):
+            raise ValueError(
+                "Sample store \"%s\" holds different components" % store.path
+            )
+
+        values = self._add_arrays(indices, elements, eigenvalues)
+
+        if self.sample_store is not None:
+            self.sample_store.append(
+                indices,
+                elements,
+                values,
+                label = label,
+                components = self.__class__._component_names
+            )
+
+    def _add_arrays(self, indices, elements, eigenvalues):
+        '''
+        update statistics with the arrays and return the values added
+        '''
+        indices = asarray(indices)
+        elements = asarray(elements, dtype = 'S2')
+
+        if self._last_indices is not None and \
+            array_equal(indices, self._last_indices) and \
+            array_equal(elements, self._last_elements):
+            rows = self._last_rows
+        else:
+            rows = array(
+                [
+                    self._get_row(i, e) 
+                    for (i, e) in zip(indices.tolist(), elements.tolist())
+                ],
+                dtype = int64
+            )
+            self._last_indices = indices.copy()
+            self._last_elements = elements.copy()
+            self._last_rows = rows
+
+        values = self._get_values(
+            asarray(eigenvalues, dtype = float).reshape(-1, 3),
+            elements
+        )
+
+        if unique(rows).shape[0] == rows.shape[0]:
+            self._update(rows, values)
+        else:
+            # the same atom more than once in a snapshot, the updates must 
+            # be done one by one
+            for (r, v) in zip(rows, values):
+                self._update([r], v[newaxis, :])
+
+        return values
+    
+    def add_tensors_from_list(self, tens_list):
+        if isinstance(tens_list, TensorList):
+            if len(tens_list) == 0:
+                return
+
+            if isinstance(tens_list, ColumnarTensorList):
+                self.add_arrays(
+                    tens_list.indices,
+                    tens_list.get_elements(),
+                    tens_list.eigenvalues,
+                    label = tens_list.filename
                 )
             else:
+                self.add_arrays(
+                    [t.index for t in tens_list],
+                    [t.element for t in tens_list],
+                    [t.eigenvalues for t in tens_list],
+                    label = tens_list.filename
+                )
+
+            if self.keep_samples:
+                for t in tens_list:
+                    self._keep_sample(t)
+
+    def merge(self, other):
+        '''
+        merge statistics gathered by other TensorStats instance (e.g. from 
+        different set of snapshots) into this one using Chan's parallel
+        combination of means and variances
+        '''
+        if not isinstance(other, TensorStats):
+            raise TypeError("unsupported type %s" % type(other))
+
+        if len(self._rows) == 0:
+            self.shift_elements = list(other.shift_elements)
+        elif len(other._rows) > 0 and \
+            self.shift_elements != other.shift_elements:
+            raise ValueError(
+                "Can not merge statistics of shifts of different elements"
+            )
+
+        # options of statistics read differently are not known
+        if len(self._rows) == 0 and len(self.ingested) == 0:
+            self.read_options = other.read_options
+        elif self.read_options != other.read_options:
+            self.read_options = None
+
+        if len(self._rows) == 0 and self.histograms is None and \
+            other.histograms is not None:
+            self.histograms = StreamingHistograms(
+                other.histograms.width,
+                n_bins = other.histograms.n_bins,
+                origin = other.histograms.fixed_origin,
+                capacity = self._count.shape[0]
+            )
+        if (self.histograms is None) != (other.histograms is None):
+            raise ValueError(
+                "Can not merge statistics with and without histograms"
+            )
+
+        indices = other.get_indices()
+        if len(indices) > 0:
+            other_rows = array([other._rows[i] for i in indices], dtype = int64)
+            rows = array(
+                [self._get_row(i, other.get_element(i)) for i in indices],
+                dtype = int64
+            )
+
+            if self.histograms is not None:
+                self.histograms.merge(rows, other.histograms, other_rows)
+
+            count_a = self._count[rows][:, newaxis]
+            count_b = other._count[other_rows][:, newaxis]
+            count = count_a + count_b
+            delta = other._mean[other_rows] - self._mean[rows]
+
+            self._mean[rows] += delta * count_b / count
+            self._m2[rows] += other._m2[other_rows] + \
+                delta ** 2 * count_a * count_b / count
+            self._count[rows] = count[:, 0]
+
+        if self.keep_samples:
+            for i in sorted(other.data):
+                for t in other.data[i]:
+                    self._keep_sample(t)
+
+        self.filenames = list(self.filenames) + list(other.filenames)
+        for identity in other.ingested:
+            self.add_ingested(identity)
+
+    def add_ingested(self, identity):
+        '''
+        record identity of file (absolute path, size and modification time,
+        see cache.file_identity) whose tensors were added
+        '''
+        (path, size, mtime) = identity
+        self.ingested.add((str(path), int(size), str(mtime)))
+        self._ingested_paths.add(str(path))
+
+    def is_ingested(self, identity):
+        (path, size, mtime) = identity
+        return (str(path), int(size), str(mtime)) in self.ingested
+
+    def is_changed(self, identity):
+        '''
+        return True when file of the same path but other size or 
+        modification time than 'identity' was already added
+        '''
+        return str(identity[0]) in self._ingested_paths and \
+            not self.is_ingested(identity)
+
+    def save_state(self, f):
+        '''
+        write accumulated statistics to binary (NumPy .npz) file, which can 
+        be later loaded by 'load_state' and merged with other results or 
+        updated with new files
+        '''
+        indices = self.get_indices()
+        rows = array([self._rows[i] for i in indices], dtype = int64)
+        ingested = sorted(self.ingested)
+
+        optional_arrays = {}
+        if self.read_options is not None:
+            optional_arrays['read_options'] = array(
+                json.dumps(self.read_options, sort_keys = True)
+            )
+        if self.histograms is not None:
+            if self.histograms.fixed_origin is not None:
+                optional_arrays['histogram_fixed_origin'] = array(
+                    self.histograms.fixed_origin
+                )
+            optional_arrays.update({
+                'histogram_width' : array(self.histograms.width),
+                'histogram_counts' : self.histograms.counts[rows],
+                'histogram_origin' : self.histograms.origin[rows],
+                'histogram_underflow' : self.histograms.underflow[rows],
+                'histogram_overflow' : self.histograms.overflow[rows],
+                'histogram_initialized' : self.histograms.initialized[rows]
+            })
+
+        savez(
+            f,
+            indices = array(indices, dtype = int64),
+            elements = array(
+                [self._elements[r] for r in rows], 
+                dtype = 'S2'
+            ),
+            count = self._count[rows],
+            mean = self._mean[rows],
+            m2 = self._m2[rows],
+            filenames = array(self.filenames, dtype = str),
+            file_type = array(self.file_type),
+            shield_type = array(self.shield_type),
+            components = array(self.__class__._component_names),
+            shift_elements = array(self.shift_elements, dtype = 'S2'),
+            ingested_paths = array([i[0] for i in ingested], dtype = str),
+            ingested_sizes = array([i[1] for i in ingested], dtype = int64),
+            ingested_mtimes = array([i[2] for i in ingested], dtype = str),
+            **optional_arrays
+        )
+
+    @classmethod
+    def load_state(cls, f, **kwargs):
+        '''
+        create TensorStats instance from the file written by 'save_state', 
+        'kwargs' are passed to the constructor (e.g. 'sample_store')
+        '''
+        try:
+            state = load(f)
+            components = tuple(str(c) for c in state['components'])
+            if components != cls._component_names:
                 raise ValueError(
-                    "Element mismatch between tensors"
+                    "TensorStats state file holds different components"
                 )
+
+            result = cls(
+                filenames = [str(i) for i in state['filenames']],
+                file_type = str(state['file_type']),
+                shield_type = str(state['shield_type']),
+                shift_elements = [str(e) for e in state['shift_elements']],
+                **kwargs
+            )
+
+            # states written before the options were recorded have none
+            if 'read_options' in state.files:
+                result.read_options = json.loads(str(state['read_options']))
+
+            if 'histogram_counts' in state.files:
+                fixed_origin = None
+                if 'histogram_fixed_origin' in state.files:
+                    fixed_origin = int(state['histogram_fixed_origin'])
+                result.histograms = StreamingHistograms(
+                    float(state['histogram_width']),
+                    n_bins = state['histogram_counts'].shape[1],
+                    origin = fixed_origin,
+                    capacity = result._count.shape[0]
+                )
+            else:
+                result.histograms = None
+
+            indices = state['indices'].tolist()
+            elements = state['elements'].tolist()
+            rows = array(
+                [result._get_row(i, e) for (i, e) in zip(indices, elements)],
+                dtype = int64
+            )
+
+            result._count[rows] = state['count']
+            result._mean[rows] = state['mean']
+            result._m2[rows] = state['m2']
+
+            if result.histograms is not None:
+                h = result.histograms
+                h.counts[rows] = state['histogram_counts']
+                h.origin[rows] = state['histogram_origin']
+                h.underflow[rows] = state['histogram_underflow']
+                h.overflow[rows] = state['histogram_overflow']
+                h.initialized[rows] = state['histogram_initialized']
+
+            # states written before the files were recorded have none
+            if 'ingested_paths' in state.files:
+                for identity in zip(
+                    state['ingested_paths'].tolist(),
+                    state['ingested_sizes'].tolist(),
+                    state['ingested_mtimes'].tolist()
+                ):
+                    result.add_ingested(identity)
+        except (KeyError, IOError):
+            raise ValueError(
+                "Invalid format of TensorStats state file"
+            )
+
+        return result
+
+    def add_tensors(self, tensors, chunk_size = 1024, label = ''):
+        '''
+        add tensors from any iterable (e.g. parser's iter_tensors) without 
+        holding more than 'chunk_size' of them at once. All the tensors are
+        treated as one snapshot when appended to the sample store
+        '''
+        indices = []
+        elements = []
+        eigenvalues = []
+        # parts of the snapshot for the sample store
+        stored = []
+
+        for t in tensors:
+            self.check_type(t)
+            indices.append(t.index)
+            elements.append(t.element)
+            eigenvalues.append(t.eigenvalues)
+
+            if self.keep_samples:
+                self._keep_sample(t)
+
+            if len(indices) == chunk_size:
+                values = self._add_arrays(indices, elements, eigenvalues)
+                if self.sample_store is not None:
+                    stored.append((indices, elements, values))
+                indices = []
+                elements = []
+                eigenvalues = []
+
+        if len(indices) > 0:
+            values = self._add_arrays(indices, elements, eigenvalues)
+            if self.sample_store is not None:
+                stored.append((indices, elements, values))
+
+        if len(stored) > 0:
+            self.sample_store.append(
+                [i for part in stored for i in part[0]],
+                [e for part in stored for e in part[1]],
+                concatenate([part[2] for part in stored]),
+                label = label,
+                components = self.__class__._component_names
+            )
+
+    def is_converged(self, target, components = ('iso',), min_count = 2):
+        '''
+        return True when confidence intervals of 'components' of all atoms 
+        are below 'target' and every atom has at least 'min_count' samples,
+        raise ValueError when some of the intervals can not be estimated.
+        Naive intervals are obtained from the accumulators, so they are cheap 
+        enough to be checked after every added snapshot. Intervals of other 
+        error methods use all the samples, so they are estimated again only
+        after the number of samples in the store grew by 
+        '_convergence_check_growth' since the last check
+        '''
+        n = len(self._rows)
+        if n == 0:
+            return False
+
+        count = self._count[:n]
+        if count.min() < max(min_count, 2):
+            return False
+
+        columns = [self.get_component(c) for c in components]
+        indices = self.get_indices()
+        if self.error_method == 'naive':
+            rows = array([self._rows[i] for i in indices], dtype = int64)
+            with errstate(divide = 'ignore', invalid = 'ignore'):
+                confidence_int = sqrt(
+                    self._m2[rows][:, columns] / \
+                        ((count[rows] - 1) * count[rows])[:, newaxis]
+                ) * self.__class__._confidence_factor
         else:
-            self.data[tensor.index] = [tensor]
-    
-    def add_tensors_from_list(self, tens_list):
-        if isinstance(tens_list, TensorList):
-            for t in tens_list:
-                self.add_tensor(t)
+            n_samples = 0
+            if self.sample_store is not None:
+                n_samples = len(self.sample_store)
+            if n_samples < self._next_convergence_check:
+                return False
+            self._next_convergence_check = int(ceil(
+                n_samples * (1.0 + self.__class__._convergence_check_growth)
+            ))
+
+            (std_err_mean, confidence_int) = self._estimate_errors(
+                indices,
+                components = columns
+            )
+
+        # such intervals would never get below the target
+        invalid = ~isfinite(confidence_int).all(axis = 1)
+        if invalid.any():
+            raise ValueError(
+                "Confidence intervals of atoms %s can not be estimated" % \
+                    ', '.join(str(i) for i in array(indices)[invalid])
+            )
+
+        return bool((confidence_int < target).all())
+
+    def get_indices(self):
+        '''
+        return sorted list of indices of atoms gathered so far
+        '''
+        return sorted(self._rows)
+
+    def get_element(self, index):
+        return self._elements[self._rows[index]]
+
+    def get_stats(self, indices = None):
+        '''
+        return sample counts and arrays (atoms x components) of mean, sample 
+        standard deviation, standard error of the mean and 95% confidence 
+        interval for atoms in 'indices' (all atoms sorted by index by default).
+        Components are the isotropic value, the three principal components
+        and the descriptors listed by get_component_names
+        '''
+        if indices is None:
+            indices = self.get_indices()
+
+        rows = array([self._rows[i] for i in indices], dtype = int64)
+        count = self._count[rows]
+        mean = self._mean[rows]
+
+        with errstate(divide = 'ignore', invalid = 'ignore'):
+            std_dev = sqrt(self._m2[rows] / (count - 1)[:, newaxis])
+            std_err_mean = std_dev / sqrt(count)[:, newaxis]
+
+        confidence_int = std_err_mean * self.__class__._confidence_factor
+
+        if self.error_method != 'naive':
+            (std_err_mean, confidence_int) = self._estimate_errors(indices)
+
+        return (count, mean, std_dev, std_err_mean, confidence_int)
+
+    def _check_store(self, purpose):
+        store = self.sample_store
+        if store is None or len(store) == 0:
+            raise ValueError(
+                "%s requires samples in the sample store" % purpose
+            )
+
+        if list(store.components) != list(self.__class__._component_names):
+            raise ValueError(
+                "Sample store \"%s\" holds different components" % store.path
+            )
+
+        return store
+
+    def _get_samples(self, indices, purpose):
+        '''
+        return (snapshots x atoms x components) samples of atoms in 'indices'
+        from the sample store, which is memory-mapped (not copied) when all 
+        the atoms are requested
+        '''
+        store = self._check_store(purpose)
+        samples = store.get_samples()
+        columns = store.get_columns(indices)
+        if not array_equal(columns, arange(samples.shape[1])):
+            samples = samples[:, columns, :]
+
+        return samples
+
+    def write_convergence(self, outp_file, stride = 1):
+        '''
+        write convergence traces, i.e. cumulative count, mean and (naive) 
+        confidence interval of every component of every atom after each 
+        'stride'-th snapshot of the sample store, to binary file (uncompressed
+        NumPy .npz archive) holding arrays 'indices', 'elements', 'snapshots' 
+        (numbers of snapshots at the points of the traces) and 'count', 'mean'
+        and 'ci' (points x atoms x components) along with JSON 'header'
+        '''
+        cls = self.__class__
+        indices = self.get_indices()
+        samples = self._get_samples(indices, "Convergence trace")
+
+        (snapshots, count, mean, confidence_int) = calc_convergence(
+            samples,
+            stride = stride,
+            confidence_factor = cls._confidence_factor
+        )
+
+        header = {
+            'content' : 'TensorStatsConvergence',
+            'labels' : self.sample_store.get_labels(),
+            'file_type' : self.file_type,
+            'shielding_type' : self.shield_type,
+            'components' : list(cls._component_names),
+            'shift_elements' : list(self.shift_elements),
+            'confidence_factor' : cls._confidence_factor,
+            'stride' : stride
+        }
+
+        write_npz(
+            outp_file,
+            header,
+            indices = array(indices, dtype = int64),
+            elements = array(
+                [self.get_element(i) for i in indices], 
+                dtype = 'S2'
+            ),
+            snapshots = snapshots,
+            count = count,
+            mean = mean,
+            ci = confidence_int
+        )
+
+    def _iter_samples(self, indices, components, purpose):
+        '''
+        generator reading samples of atoms in 'indices' from the sample store
+        in chunks of atoms of about '_sample_chunk_bytes', so that the store
+        is never copied to memory as a whole. Tuples of slice of 'indices' 
+        and (snapshots x atoms x components) array of samples of 'components'
+        (positions in the arrays of statistics) are yielded
+        '''
+        store = self._check_store(purpose)
+        samples = store.get_samples()
+        columns = store.get_columns(indices)
+
+        step = max(
+            1,
+            self.__class__._sample_chunk_bytes // max(
+                1,
+                samples.shape[0] * samples.shape[2] * samples.itemsize
+            )
+        )
+        for begin in xrange(0, columns.shape[0], step):
+            chunk = slice(begin, min(begin + step, columns.shape[0]))
+            yield (chunk, samples[:, columns[chunk]][:, :, components])
+
+    def _estimate_errors(self, indices, components = None):
+        '''
+        return arrays (atoms x components) of standard error of the mean and
+        confidence interval of atoms in 'indices' estimated by 'error_method'
+        from the samples in the sample store. 'components' are positions in
+        the arrays of statistics (all by default)
+        '''
+        cls = self.__class__
+        if components is None:
+            components = range(cls._n_components)
+        purpose = "Error estimation method \"%s\"" % self.error_method
+
+        std_err_mean = empty((len(indices), len(components)))
+        confidence_int = empty((len(indices), len(components)))
+
+        if self.error_method == 'bootstrap':
+            inefficiency = concatenate(
+                [
+                    statistical_inefficiency(samples[:, :, 0])
+                    for (chunk, samples) in self._iter_samples(
+                        indices,
+                        [0],
+                        purpose
+                    )
+                ]
+            )
+            inefficiency = inefficiency[~isnan(inefficiency)]
+            block_size = 1
+            if inefficiency.shape[0] > 0:
+                block_size = int(ceil(median(inefficiency)))
+
+        for (chunk, samples) in self._iter_samples(
+            indices,
+            components,
+            purpose
+        ):
+            if self.error_method == 'bootstrap':
+                (sem, ci) = bootstrap_errors(
+                    samples,
+                    n_resamples = cls._bootstrap_resamples,
+                    confidence = cls._confidence_level,
+                    block_size = block_size,
+                    seed = cls._bootstrap_seed
+                )
+            else:
+                if self.error_method == 'block':
+                    sem = block_sem(samples)
+                else:
+                    sem = inefficiency_sem(samples)
+                ci = sem * cls._confidence_factor
+
+            std_err_mean[chunk] = sem
+            confidence_int[chunk] = ci
+
+        return (std_err_mean, confidence_int)
     
     def write_tensors(self, index, outp_file, verb_level = 1):
+        if index not in self.data:
+            raise ValueError(
+                "Samples of atom No. %d were not kept" % index
+            )
+
         outp_file.write(
             "# Array NMR Shielding/shift tensors for atom No. %d\n" % index
         )
@@ -450,33 +2124,142 @@ class TensorStats(object):
             )
             t.write_to_file(outp_file, level = verb_level)
     
+    def write_binary(self, outp_file):
+        '''
+        write the statistics in full precision to binary file (uncompressed 
+        NumPy .npz archive) holding arrays 'indices', 'elements', 'count' and
+        arrays (atoms x components) 'mean', 'std', 'sem' and 'ci' along with 
+        JSON 'header' describing them. Histograms of isotropic values, if
+        kept, are stored as (atoms x bins) 'histogram' with global indices of
+        the first bins 'histogram_origin' and 'histogram_underflow' and
+        'histogram_overflow' counts
+        '''
+        indices = self.get_indices()
+        (count, mean, std_dev, std_err_mean, confidence_int) = \
+            self.get_stats(indices)
+
+        histogram_arrays = {}
+        histogram_width = None
+        if self.histograms is not None:
+            rows = array([self._rows[i] for i in indices], dtype = int64)
+            histogram_width = self.histograms.width
+            histogram_arrays = {
+                'histogram' : self.histograms.counts[rows],
+                'histogram_origin' : self.histograms.origin[rows],
+                'histogram_underflow' : self.histograms.underflow[rows],
+                'histogram_overflow' : self.histograms.overflow[rows]
+            }
+
+        header = {
+            'content' : 'TensorStats',
+            'filenames' : list(self.filenames),
+            'file_type' : self.file_type,
+            'shielding_type' : self.shield_type,
+            'components' : list(self.__class__._component_names),
+            'shift_elements' : list(self.shift_elements),
+            'confidence_factor' : self.__class__._confidence_factor,
+            'error_method' : self.error_method,
+            'histogram_width' : histogram_width
+        }
+
+        write_npz(
+            outp_file,
+            header,
+            indices = array(indices, dtype = int64),
+            elements = array(
+                [self.get_element(i) for i in indices], 
+                dtype = 'S2'
+            ),
+            count = count,
+            mean = mean,
+            std = std_dev,
+            sem = std_err_mean,
+            ci = confidence_int,
+            **histogram_arrays
+        )
+
+    def get_percentiles(self, indices = None, percentiles = (50,)):
+        '''
+        return (atoms x percentiles) array of percentiles of isotropic values
+        of atoms in 'indices' (all atoms sorted by index by default) estimated
+        from their histograms. Percentiles falling outside the histogram range
+        are NaN
+        '''
+        if self.histograms is None:
+            raise ValueError("Histograms of values were not kept")
+
+        if indices is None:
+            indices = self.get_indices()
+
+        rows = array([self._rows[i] for i in indices], dtype = int64)
+        return self.histograms.get_percentiles(rows, percentiles)
+
+    def write_percentiles(self, outp_file, percentiles = (5, 25, 50, 75, 95)):
+        '''
+        write table of percentiles of isotropic values of all atoms
+        '''
+        indices = self.get_indices()
+        values = self.get_percentiles(indices, percentiles)
+
+        outp_file.write("# percentiles of isotropic values\n")
+        outp_file.write(
+            "#%9s %6s" % ("Atom", "count") + \
+            ''.join(" %10s" % ("%g%%" % p) for p in percentiles) + "\n"
+        )
+
+        line_fmt = "%6d %2s %6d" + " %10.3f" * len(percentiles) + "\n"
+        for (j, index) in enumerate(indices):
+            outp_file.write(
+                line_fmt % (
+                    (index, self.get_element(index),
+                        self._count[self._rows[index]]) + \
+                    tuple(values[j])
+                )
+            )
+
     def write_header(self, outp_file):
         outp_file.write(
             self.__class__._stat_header
         )
         
-    def write_tensor_stats(self, index, outp_file):
-        iso_values = array([t.get_sigma_iso() for t in self.data[index]])
-        
-        mean = iso_values.mean()
-        std_dev = iso_values.std(ddof = 1)
-        std_err_mean = std_dev / sqrt(iso_values.size)
-        confidence_int = std_err_mean * 1.96
-        outp_file.write(
-            self.__class__._stat_line_fmt % (
-                index,
-                self.data[index][0].element,
-                iso_values.size,
-                mean,
-                std_dev,
-                std_err_mean,
-                confidence_int
-            )
+    def write_tensor_stats(self, index, outp_file, component = 'iso'):
+        self._write_stat_lines(
+            outp_file,
+            [index],
+            self.get_stats([index]),
+            self.get_component(component)
         )
+
+    def _write_stat_lines(self, outp_file, indices, stats, k):
+        (count, mean, std_dev, std_err_mean, confidence_int) = stats
+
+        for (j, index) in enumerate(indices):
+            outp_file.write(
+                self.__class__._stat_line_fmt % (
+                    index,
+                    self.get_element(index),
+                    count[j],
+                    mean[j, k],
+                    std_dev[j, k],
+                    std_err_mean[j, k],
+                    confidence_int[j, k]
+                )
+            )
         
-    def write_stats(self, outp_file):
-        self.write_header(outp_file)
-        
-        for k in sorted(self.data):
-            self.write_tensor_stats(k, outp_file)
-        
\ No newline at end of file
+    def write_stats(self, outp_file, components = ('iso',)):
+        '''
+        write table of statistics of every component in 'components' (the 
+        isotropic value by default), the tables of other components than the
+        isotropic value are preceded by a comment line naming the component
+        '''
+        columns = [self.get_component(c) for c in components]
+        # statistics of all atoms at once, errors other than naive are 
+        # estimated from all the samples together
+        indices = self.get_indices()
+        stats = self.get_stats(indices)
+
+        for (c, k) in zip(components, columns):
+            if c != 'iso':
+                outp_file.write("# component: %s\n" % c)
+            self.write_header(outp_file)
+            self._write_stat_lines(outp_file, indices, stats, k)
@@ -0,0 +1,182 @@
+"""
+Fixed-memory histograms of values streamed in one by one, e.g. of isotropic
+shifts of every atom over many snapshots. The bins of all the histograms lie
+on one global grid, so the histograms can be merged, exactly when they share
+a fixed range of bins.
+"""
+from numpy import asarray, zeros, arange, floor, isfinite, newaxis, where, \
+    cumsum, errstate, repeat, add, int64, nan
+
+class StreamingHistograms(object):
+    '''
+    histograms of values of 'capacity' rows (e.g. atoms). Bin k covers
+    values [k * width, (k + 1) * width) for all the rows and all the
+    instances, every row keeps 'n_bins' bins and counts of values below
+    (underflow) and above (overflow) them, so that the memory does not grow
+    with the number of values.
+
+    When 'origin' (global index of the first bin) is given, all the rows
+    keep the same bins, so histograms of any runs with the same bins merge
+    exactly. Otherwise the bins of every row are centred on its first value,
+    which depends on the order of the values, and counts of other histograms
+    outside the bins of this one go to its underflow or overflow when they
+    are merged
+    '''
+    def __init__(self,
+        width,
+        n_bins = 200,
+        capacity = 16,
+        origin = None
+    ):
+        if not width > 0:
+            raise ValueError("Width of histogram bins must be positive")
+        if n_bins < 1:
+            raise ValueError("Histogram must have at least one bin")
+
+        self.width = float(width)
+        self.n_bins = int(n_bins)
+        self.fixed_origin = None
+        if origin is not None:
+            self.fixed_origin = int(origin)
+        self.counts = zeros((0, self.n_bins), dtype = int64)
+        # global index of the first bin of every row
+        self.origin = zeros(0, dtype = int64)
+        self.underflow = zeros(0, dtype = int64)
+        self.overflow = zeros(0, dtype = int64)
+        # rows whose origin was already set
+        self.initialized = zeros(0, dtype = bool)
+        self.reserve(capacity)
+
+    def reserve(self, capacity):
+        '''
+        make room for 'capacity' rows, keeping the existing ones
+        '''
+        n = self.origin.shape[0]
+        if capacity <= n:
+            return
+
+        counts = zeros((capacity, self.n_bins), dtype = int64)
+        counts[:n] = self.counts
+        self.counts = counts
+
+        for name in ('origin', 'underflow', 'overflow', 'initialized'):
+            old = getattr(self, name)
+            new = zeros(capacity, dtype = old.dtype)
+            new[:n] = old
+            setattr(self, name, new)
+
+    def is_compatible(self, other):
+        return self.width == other.width and self.n_bins == other.n_bins and \
+            self.fixed_origin == other.fixed_origin
+
+    def _get_bins(self, values):
+        return floor(values / self.width).astype(int64)
+
+    def _add(self, rows, positions, weights):
+        '''
+        add 'weights' to bins at 'positions' relative to the origins of
+        'rows', positions outside the histograms go to underflow or overflow
+        '''
+        below = positions < 0
+        above = positions >= self.n_bins
+        inside = ~(below | above)
+
+        add.at(self.underflow, rows[below], weights[below])
+        add.at(self.overflow, rows[above], weights[above])
+        add.at(self.counts, (rows[inside], positions[inside]), weights[inside])
+
+    def update(self, rows, values):
+        '''
+        add one value to each of 'rows', non-finite values are ignored
+        '''
+        rows = asarray(rows, dtype = int64)
+        values = asarray(values, dtype = float)
+        finite = isfinite(values)
+        rows = rows[finite]
+        bins = self._get_bins(values[finite])
+
+        # fixed bins or the first value of the row in the middle of its bins
+        new = ~self.initialized[rows]
+        if self.fixed_origin is not None:
+            self.origin[rows[new]] = self.fixed_origin
+        else:
+            self.origin[rows[new]] = bins[new] - self.n_bins // 2
+        self.initialized[rows[new]] = True
+
+        self._add(
+            rows,
+            bins - self.origin[rows],
+            zeros(rows.shape[0], dtype = int64) + 1
+        )
+
+    def merge(self, rows, other, other_rows):
+        '''
+        add histograms of 'other_rows' of other StreamingHistograms instance
+        with the same bins to (unique) 'rows', the result is exact only with
+        fixed origin
+        '''
+        if not self.is_compatible(other):
+            raise ValueError("Can not merge histograms with different bins")
+
+        rows = asarray(rows, dtype = int64)
+        other_rows = asarray(other_rows, dtype = int64)
+        used = other.initialized[other_rows]
+        rows = rows[used]
+        other_rows = other_rows[used]
+
+        new = ~self.initialized[rows]
+        self.origin[rows[new]] = other.origin[other_rows[new]]
+        self.initialized[rows[new]] = True
+
+        shift = other.origin[other_rows] - self.origin[rows]
+        positions = arange(self.n_bins)[newaxis, :] + shift[:, newaxis]
+        self._add(
+            repeat(rows, self.n_bins),
+            positions.ravel(),
+            other.counts[other_rows].ravel()
+        )
+        self.underflow[rows] += other.underflow[other_rows]
+        self.overflow[rows] += other.overflow[other_rows]
+
+    def get_edges(self, rows):
+        '''
+        return (rows x (n_bins + 1)) array of bin edges
+        '''
+        rows = asarray(rows, dtype = int64)
+        return (self.origin[rows][:, newaxis] + arange(self.n_bins + 1)) * \
+            self.width
+
+    def get_percentiles(self, rows, percentiles = (50,)):
+        '''
+        return (rows x percentiles) array of percentiles (e.g. 50 for median)
+        interpolated linearly within the bins. Percentiles falling to the
+        underflow or overflow and those of empty rows are NaN
+        '''
+        rows = asarray(rows, dtype = int64)
+        counts = self.counts[rows]
+        underflow = self.underflow[rows][:, newaxis]
+        total = counts.sum(axis = 1)[:, newaxis] + underflow + \
+            self.overflow[rows][:, newaxis]
+
+        cumulative = cumsum(counts, axis = 1) + underflow
+        target = asarray(percentiles, dtype = float)[newaxis, :] / 100.0 * \
+            total
+
+        # first non-empty bin reaching the target
+        k = (
+            (cumulative[:, :, newaxis] < target[:, newaxis, :]) | \
+                (cumulative[:, :, newaxis] == 0)
+        ).sum(axis = 1)
+        j = k.clip(0, self.n_bins - 1)
+        r = arange(rows.shape[0])[:, newaxis]
+        before = where(k > 0, cumulative[r, (k - 1).clip(0)], underflow)
+        in_bin = counts[r, j]
+
+        with errstate(divide = 'ignore', invalid = 'ignore'):
+            fraction = where(in_bin > 0, (target - before) / in_bin, 0.0)
+            result = (self.origin[rows][:, newaxis] + k + fraction) * \
+                self.width
+
+        result[(target < underflow) | (k >= self.n_bins) | (total == 0)] = nan
+
+        return result
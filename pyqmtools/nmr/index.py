@@ -0,0 +1,142 @@
+"""
+Sidecar index of QM output files. The index is a small JSON file stored next
+to the output and holding byte offsets of the parts of the output read by the
+NMR parsers, so that they can seek directly to the data instead of scanning
+the whole file.
+"""
+import os
+import json
+
+class OutputIndex(object):
+    '''
+    byte offsets of NMR section, nucleus blocks, input echo and final geometry
+    in a single output file. Offsets are stored as [begin, end) pairs, the
+    index is valid only as long as the size and modification time of the
+    output file match the recorded ones
+    '''
+    _suffix = '.nmridx'
+    _version = 1
+
+    def __init__(
+        self,
+        filename,
+        file_type = ''
+    ):
+        self.filename = filename
+        self.file_type = file_type
+        st = os.stat(filename)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        # [begin, end) of the NMR section
+        self.section = None
+        # [begin, end) of the input echo
+        self.input_echo = None
+        # offset of the header of the last geometry printed
+        self.geometry = None
+        # list of [begin, end, element, indices] of every nucleus block,
+        # 'indices' maps atom numbering type to the index of atom
+        self.blocks = []
+
+    @classmethod
+    def get_index_filename(cls, filename):
+        return filename + cls._suffix
+
+    def add_block(
+        self,
+        begin,
+        end,
+        element,
+        indices
+    ):
+        self.blocks.append([begin, end, element, indices])
+
+    def is_valid(
+        self,
+        file_type = None
+    ):
+        '''
+        return True when the indexed file was not changed since the index was
+        built (and when it was built for 'file_type', if given)
+        '''
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+
+        if file_type is not None and file_type != self.file_type:
+            return False
+
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def get_blocks(
+        self,
+        numbering,
+        selected = None
+    ):
+        '''
+        return list of (begin, end) offsets of nucleus blocks in the order of
+        the file. 'selected' is optional function called with atom index
+        (according to 'numbering') and element symbol and returning True for
+        blocks to be included
+        '''
+        result = []
+        for (begin, end, element, indices) in self.blocks:
+            if selected is None or selected(indices[numbering], element):
+                result.append((begin, end))
+
+        return result
+
+    def save(self):
+        data = {
+            'version' : self.__class__._version,
+            'file_type' : self.file_type,
+            'size' : self.size,
+            'mtime' : self.mtime,
+            'section' : self.section,
+            'input_echo' : self.input_echo,
+            'geometry' : self.geometry,
+            'blocks' : self.blocks
+        }
+
+        with open(self.get_index_filename(self.filename), 'w') as f:
+            json.dump(data, f, separators = (',', ':'))
+
+    @classmethod
+    def load(
+        cls,
+        filename,
+        file_type = None
+    ):
+        '''
+        return the index of 'filename' or None, if there is no index or it is
+        out of date
+        '''
+        try:
+            with open(cls.get_index_filename(filename), 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        try:
+            if data['version'] != cls._version:
+                return None
+
+            index = cls.__new__(cls)
+            index.filename = filename
+            index.file_type = str(data['file_type'])
+            index.size = data['size']
+            index.mtime = data['mtime']
+            index.section = data['section']
+            index.input_echo = data['input_echo']
+            index.geometry = data['geometry']
+            index.blocks = [
+                [begin, end, str(element), indices]
+                    for (begin, end, element, indices) in data['blocks']
+            ]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+        if not index.is_valid(file_type):
+            return None
+
+        return index
@@ -0,0 +1,116 @@
+"""
+Binary output of tensor data. The arrays are stored in uncompressed NumPy
+.npz archives together with a small JSON header describing them. As the
+members are not compressed, they can be memory-mapped directly from the
+archive.
+"""
+import json
+import struct
+import zipfile
+from numpy import array, savez, load, memmap
+from numpy.lib import format as npformat
+
+_header_key = 'header'
+_format_version = 1
+# size of the fixed part of zip local file header
+_zip_local_header_size = 30
+
+def write_npz(
+    f,
+    header,
+    **arrays
+):
+    '''
+    write 'arrays' and JSON-serializable dictionary 'header' to .npz file
+    '''
+    header = dict(header, format_version = _format_version)
+
+    savez(
+        f,
+        header = array(json.dumps(header, sort_keys = True)),
+        **arrays
+    )
+
+def read_npz(
+    filename,
+    mmap = False
+):
+    '''
+    return tuple (header, arrays) read from .npz file written by write_npz.
+    If 'mmap' is set, the arrays are copy-on-write memory maps of the file, so
+    they can be modified without affecting the file
+    '''
+    if mmap:
+        arrays = _map_npz(filename)
+    else:
+        with open(filename, 'rb') as f:
+            data = load(f)
+            arrays = dict((k, data[k]) for k in data.files)
+
+    try:
+        header = json.loads(str(arrays.pop(_header_key)))
+    except (KeyError, ValueError):
+        raise ValueError(
+            "Missing or invalid header of binary file \"%s\"" % filename
+        )
+
+    return (header, arrays)
+
+def _map_npz(filename):
+    '''
+    return dictionary of arrays memory-mapped from members of uncompressed
+    .npz file
+    '''
+    result = {}
+    archive = zipfile.ZipFile(filename)
+    try:
+        members = archive.infolist()
+    finally:
+        archive.close()
+
+    with open(filename, 'rb') as f:
+        for info in members:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    "Compressed arrays can not be memory-mapped"
+                )
+
+            # the local header may have different extra field than the
+            # central directory entry
+            f.seek(info.header_offset)
+            local_header = f.read(_zip_local_header_size)
+            (name_length, extra_length) = struct.unpack(
+                '<HH',
+                local_header[26:30]
+            )
+            begin = info.header_offset + _zip_local_header_size + \
+                name_length + extra_length
+
+            f.seek(begin)
+            version = npformat.read_magic(f)
+            if version == (1, 0):
+                (shape, fortran_order, dtype) = \
+                    npformat.read_array_header_1_0(f)
+            else:
+                (shape, fortran_order, dtype) = \
+                    npformat.read_array_header_2_0(f)
+
+            name = info.filename
+            if name.endswith('.npy'):
+                name = name[:-4]
+
+            if len(shape) == 0 or 0 in shape or dtype.hasobject:
+                # scalars and empty arrays are not worth mapping
+                f.seek(begin)
+                result[name] = npformat.read_array(f)
+            else:
+                result[name] = memmap(
+                    filename,
+                    dtype = dtype,
+                    mode = 'c',
+                    offset = f.tell(),
+                    shape = shape,
+                    order = 'F' if fortran_order else 'C'
+                )
+
+    return result
@@ -1,4 +1,13 @@
 from datastruct import *
+from index import OutputIndex
+from pyqmtools.util.fileio import input_file, is_plain_file, iter_archive, \
+    is_archive
+from numpy import char, frombuffer, nonzero, uint8
+from multiprocessing import Pool
+from StringIO import StringIO
+import os
+import mmap
+import tarfile
 import re
 
 class NMRTensorReadError(Exception):
@@ -6,6 +15,70 @@ class NMRTensorReadError(Exception):
 
 class NMRFinishReadException(Exception):
     pass
+
+def _fixed_width_floats(
+    lines,
+    begin,
+    width,
+    count,
+    stride = None
+):
+    '''
+    decode 'count' fixed-width numeric fields starting at column 'begin' of 
+    each line into (lines x count) array in one go. Fields start every 
+    'stride' columns (right after each other by default). Fields filled with 
+    asterisks (Fortran format overflow) are decoded as zero
+    '''
+    if len(lines) == 0:
+        return zeros((0, count))
+
+    if stride is None:
+        stride = width
+
+    end = begin + stride * count
+    chars = array(lines, dtype = 'S%d' % end).view(uint8).reshape(-1, end)
+    fields = chars[:, begin:end].reshape(-1, count, stride)[:, :, :width]
+    fields = fields.copy()
+
+    overflow = (fields == ord('*')).all(axis = 2)
+    fields[overflow] = frombuffer(' ' * (width - 1) + '0', dtype = uint8)
+
+    return fields.view('S%d' % width).reshape(-1, count).astype(float)
+
+def _map_file(f):
+    '''
+    return read-only memory map of the whole file or None when the file can 
+    not be memory-mapped
+    '''
+    try:
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # empty files and special files can not be mapped
+        return None
+
+def _read_ranges(
+    f,
+    ranges,
+    max_gap = 4096
+):
+    '''
+    generator yielding contents of byte ranges [begin, end) of file 'f'. 
+    Ranges separated by at most 'max_gap' bytes are fetched by a single read
+    '''
+    k = 0
+    while k < len(ranges):
+        j = k + 1
+        while j < len(ranges) and ranges[j][0] - ranges[j - 1][1] <= max_gap:
+            j += 1
+
+        begin = ranges[k][0]
+        f.seek(begin)
+        data = f.read(ranges[j - 1][1] - begin)
+
+        for (b, e) in ranges[k:j]:
+            yield data[b - begin:e - begin]
+
+        k = j
     
 class GaussianOutputParser(object):
     '''
@@ -16,124 +89,478 @@ class GaussianOutputParser(object):
     _tensor_begin = "Isotropic ="
     _eigenvalues  = "Eigenvalues:"
     _eigenvectors = "Eigenvectors:"
+    # labels of the Cartesian tensor lines, each line holds one column
+    _cartesian_labels = ("XX=", "XY=", "XZ=")
+    _file_type = "Gaussian 0X output"
+    _geometry_headers = ("Standard orientation:", "Input orientation:")
+    # number of blocks decoded at once by iter_tensors
+    _chunk_size = 64
 
     def __init__(
         self,
         filename = '',
         max_index = 0,
+        columnar = False,
+        selection = None,
+        cache = None,
+        use_index = True,
+        fileobj = None,
+        from_cartesian = False,
         **kwargs
     ):
         self.filename = filename
+        # already opened input (e.g. member of tar archive) read instead of
+        # opening 'filename', which then serves only as a label
+        self.fileobj = fileobj
         self.shielding_type = 'total'
+        # calculate eigenvalues and eigenvectors from the full Cartesian 
+        # tensors instead of reading the (less precise) printed values
+        self.from_cartesian = from_cartesian
+        # optional ParseCache consulted by read()
+        self.cache = cache
+        # seek to the data using up-to-date OutputIndex if there is one
+        self.use_index = use_index
         self.max_index = max_index
+        # AtomSelection applied to block headers before decoding the data
+        self.selection = selection
+        # store results in ColumnarTensorList instead of plain TensorList
+        self.columnar = columnar
         
-    def _g0x_float(self, v):
-        if v == "*" * len(v):
-            return 0.0
-        else:
-            return float(v)
-    
-    def _process_block(
+    def _map_section(
         self,
-        block,
-        check_index = False
+        f
     ):
-        #print block
-        first_line = block[0].split()
-        result = SigmaTensor()
-        result.index = int(first_line[0])
-        result.element = first_line[1]
-        
-        if check_index and (result.index > self.max_index):
-            raise NMRFinishReadException
+        '''
+        locate the NMR section by searching memory-mapped file and return the 
+        list of lines following the section header, up to and including the 
+        end line. Returns None when the file can not be memory-mapped
+        '''
+        mm = _map_file(f)
+        if mm is None:
+            return None
+
+        try:
+            begin = mm.find(self.__class__._section_begin)
+            if begin < 0:
+                return []
+
+            begin = mm.find('\n', begin) + 1
+            if begin == 0:
+                return []
+
+            end = mm.find(self.__class__._section_end, begin)
+            if end < 0:
+                end = mm.size()
+            else:
+                end = mm.find('\n', end) + 1 or mm.size()
 
-        if self.__class__._eigenvalues in block[4][:15]:
-            eigvals = (
+            return mm[begin:end].splitlines(True)
+        finally:
+            mm.close()
 
+    def _scan_section(
+        self,
+        f
+    ):
+        '''
+        generator yielding lines following the header of NMR section, reading
+        the file line by line
+        '''
+        section_found = False
+
+        for line in f:
+            if section_found:
+                yield line
+            elif self.__class__._section_begin in line:
+                section_found = True
+
+    def _find_section(
+        self,
+        f
+    ):
+        '''
+        return byte offset of the NMR section header found by searching 
+        memory-mapped file, -1 if there is no such section, or None when the 
+        file can not be memory-mapped
+        '''
+        mm = _map_file(f)
+        if mm is None:
+            return None
+
+        try:
+            return mm.find(self.__class__._section_begin)
+        finally:
+            mm.close()
+
+    def _is_plain(self):
+        '''
+        return True when the input is plain file which can be memory-mapped 
+        and indexed
+        '''
+        return self.fileobj is None and is_plain_file(self.filename)
+
+    def _load_index(self):
+        if not self.use_index or not self._is_plain():
+            return None
+
+        return OutputIndex.load(self.filename, self.__class__._file_type)
+
+    def build_index(
+        self
+    ):
+        '''
+        scan the file and return OutputIndex holding offsets of the NMR 
+        section, of the tensor blocks and of the last printed geometry
+        '''
+        cls = self.__class__
+        if not self._is_plain():
+            raise NMRTensorReadError(
+                "Only plain files can be indexed"
             )
-            result.eigenvalues = array(
-                [
-                    self._g0x_float(block[4][15:26]), 
-                    self._g0x_float(block[4][26:37]), 
-                    self._g0x_float(block[4][37:48])
-                ]
+
+        index = OutputIndex(self.filename, cls._file_type)
+
+        with open(self.filename, 'rb') as f:
+            mm = _map_file(f)
+            if mm is None:
+                return index
+
+            try:
+                for header in cls._geometry_headers:
+                    pos = mm.rfind(header)
+                    if pos >= 0:
+                        index.geometry = mm.rfind('\n', 0, pos) + 1
+                        break
+
+                begin = mm.find(cls._section_begin)
+                if begin < 0:
+                    return index
+
+                body = mm.find('\n', begin) + 1
+                if body == 0:
+                    return index
+
+                stop = mm.find(cls._section_end, body)
+                if stop < 0:
+                    # the last block may be truncated and is not indexed
+                    blocks_end = None
+                    section_end = mm.size()
+                else:
+                    blocks_end = mm.rfind('\n', 0, stop) + 1
+                    section_end = mm.find('\n', stop) + 1 or mm.size()
+                index.section = [begin, section_end]
+
+                starts = []
+                pos = mm.find(cls._tensor_begin, body, section_end)
+                while pos >= 0:
+                    starts.append(mm.rfind('\n', 0, pos) + 1)
+                    pos = mm.find(cls._tensor_begin, pos + 1, section_end)
+
+                for (begin, end) in zip(starts, starts[1:] + [blocks_end]):
+                    if end is None:
+                        break
+
+                    fields = mm[begin:end].split(None, 2)
+                    index.add_block(
+                        begin,
+                        end,
+                        fields[1],
+                        {'input' : int(fields[0])}
+                    )
+            except (ValueError, IndexError):
+                raise NMRTensorReadError("Failed to index Gaussian output")
+            finally:
+                mm.close()
+
+        return index
+
+    def _is_selected(
+        self,
+        index,
+        element
+    ):
+        if self.max_index > 0 and index > self.max_index:
+            return False
+
+        if self.selection is not None:
+            return self.selection.is_selected(index, element)
+
+        return True
+
+    def _read_blocks(
+        self,
+        f,
+        index
+    ):
+        '''
+        generator yielding selected tensor blocks read directly from offsets
+        stored in 'index'
+        '''
+        ranges = index.get_blocks('input', self._is_selected)
+
+        for data in _read_ranges(f, ranges):
+            yield data.splitlines(True)
+
+    def _iter_blocks(
+        self,
+        lines
+    ):
+        '''
+        generator splitting lines of the NMR section into blocks of single 
+        tensors. The last block is yielded only when the end of the section is
+        found, otherwise it may be truncated
+        '''
+        block = None
+
+        for line in lines:
+            if self.__class__._section_end in line:
+                if block is not None:
+                    yield block
+                return
+
+            if self.__class__._tensor_begin in line:
+                if block is not None:
+                    yield block
+                block = []
+
+            if block is not None:
+                block.append(line)
+
+    def _decode_blocks(
+        self,
+        blocks
+    ):
+        '''
+        decode a list of tensor blocks at once into arrays of atom indices, 
+        element symbols, eigenvalues, eigenvectors and Cartesian tensors 
+        (None unless 'from_cartesian' is set), leaving out atoms which are not 
+        selected. The last item of returned tuple is True when a block beyond
+        'max_index' was reached
+        '''
+        (indices, elements) = self._decode_headers(
+            [b[0] for b in blocks]
+        )
+        finished = False
+
+        if self.max_index > 0:
+            over = nonzero(indices > self.max_index)[0]
+            if len(over) > 0:
+                blocks = blocks[:over[0]]
+                indices = indices[:over[0]]
+                elements = elements[:over[0]]
+                finished = True
+
+        if self.selection is not None:
+            keep = nonzero(self.selection.get_mask(indices, elements))[0]
+            blocks = [blocks[k] for k in keep]
+            indices = indices[keep]
+            elements = [elements[k] for k in keep]
+
+        if self.from_cartesian:
+            cartesian = self._decode_cartesian(
+                [b[j] for b in blocks for j in xrange(1, 4)]
             )
-        else:
+            (eigenvalues, eigenvectors) = calc_principal_axes(cartesian)
+
+            return (
+                indices, 
+                elements, 
+                eigenvalues, 
+                eigenvectors, 
+                cartesian, 
+                finished
+            )
+
+        eigenvalues = self._decode_eigenvalues(
+            [b[4] for b in blocks]
+        )
+
+        eigenvectors = zeros((len(blocks), 3, 3))
+        with_vectors = [k for (k, b) in enumerate(blocks) if len(b) > 5]
+        if len(with_vectors) > 0:
+            eigenvectors[with_vectors] = self._decode_eigenvectors(
+                [blocks[k][5] for k in with_vectors],
+                [blocks[k][j] for k in with_vectors for j in xrange(6, 9)]
+            )
+
+        return (indices, elements, eigenvalues, eigenvectors, None, finished)
+
+    def _decode_headers(
+        self,
+        headers
+    ):
+        fields = [h.split(None, 2) for h in headers]
+        indices = array([int(f[0]) for f in fields], dtype = int64)
+        elements = [f[1] for f in fields]
+
+        return (indices, elements)
+
+    def _decode_eigenvalues(
+        self,
+        lines
+    ):
+        markers = array(lines, dtype = 'S15')
+        if (char.find(markers, self.__class__._eigenvalues) < 0).any():
             raise NMRTensorReadError(
                 "Invalid data format"
             )
 
-        if (len(block) > 5):    
-            if self.__class__._eigenvectors in block[5][:17]:
-                for i in xrange(6,9):
-                    result.eigenvectors = array(
-                        [
-                            map(
-                                self._g0x_float,
-                                [
-                                    block[i][9:20],
-                                    block[i][20:31],
-                                    block[i][31:42]
-                                ]
-                            ) for i in xrange(6,9)
-                        ]
-                    )
+        return _fixed_width_floats(lines, 15, 11, 3)
 
-            else:
+    def _decode_cartesian(
+        self,
+        lines
+    ):
+        '''
+        decode the XX/YX/ZX, XY/YY/ZY and XZ/YZ/ZZ lines (three per tensor) 
+        into (N x 3 x 3) array of Cartesian tensors
+        '''
+        markers = array(lines, dtype = 'S6').reshape(-1, 3)
+        for (k, label) in enumerate(self.__class__._cartesian_labels):
+            if (char.find(markers[:, k], label) < 0).any():
                 raise NMRTensorReadError(
                     "Invalid data format"
                 )
 
-        return result
-    
+        # k-th line holds k-th column of the tensor
+        return _fixed_width_floats(lines, 6, 11, 3, stride = 17).reshape(
+            -1, 3, 3
+        ).transpose(0, 2, 1).copy()
+
+    def _decode_eigenvectors(
+        self,
+        marker_lines,
+        lines
+    ):
+        markers = array(marker_lines, dtype = 'S17')
+        if (char.find(markers, self.__class__._eigenvectors) < 0).any():
+            raise NMRTensorReadError(
+                "Invalid data format"
+            )
+
+        return _fixed_width_floats(lines, 9, 11, 3).reshape(-1, 3, 3)
+
+    def _make_tensors(
+        self,
+        blocks
+    ):
+        (indices, elements, eigenvalues, eigenvectors, cartesian, finished) = \
+            self._decode_blocks(blocks)
+
+        tensors = []
+        for k in xrange(len(elements)):
+            tensor = SigmaTensor(
+                element = elements[k],
+                index = int(indices[k]),
+                shielding_type = self.shielding_type
+            )
+            tensor.eigenvalues = eigenvalues[k]
+            tensor.eigenvectors = eigenvectors[k]
+            if cartesian is not None:
+                tensor.cartesian_rep = cartesian[k]
+                tensor.symm_tensor = symmetrize_tensors(cartesian[k])
+            tensors.append(tensor)
+
+        return (tensors, finished)
+
+    def iter_tensors(
+        self
+    ):
+        '''
+        generator yielding SigmaTensor instances as the tensor blocks are read,
+        without building the whole TensorList. The blocks are decoded in small
+        chunks, the file is not read any further once 'max_index' is reached
+        '''
+        chunk_size = self.__class__._chunk_size
+
+        with input_file(self.filename, self.fileobj) as f:
+            index = self._load_index()
+            if index is not None:
+                block_source = self._read_blocks(f, index)
+            else:
+                offset = None
+                if self._is_plain():
+                    offset = self._find_section(f)
+                if offset is not None:
+                    if offset < 0:
+                        return
+                    f.seek(offset)
+                block_source = self._iter_blocks(self._scan_section(f))
+
+            blocks = []
+            finished = False
+            try:
+                for block in block_source:
+                    blocks.append(block)
+                    if len(blocks) < chunk_size:
+                        continue
+
+                    (tensors, finished) = self._make_tensors(blocks)
+                    blocks = []
+                    for t in tensors:
+                        yield t
+
+                    if finished:
+                        return
+
+                if len(blocks) > 0:
+                    (tensors, finished) = self._make_tensors(blocks)
+                    for t in tensors:
+                        yield t
+            except (TypeError, ValueError, IndexError):
+                raise NMRTensorReadError("Failed to read Gaussian NMR tensor")
+
     def read(
         self
     ):
-        section_found = False
+        if self.cache is not None:
+            return self.cache.read(self)
+
+        return self._read()
 
-        result = TensorList()
+    def _read(
+        self
+    ):
+        if self.columnar:
+            result = ColumnarTensorList()
+        else:
+            result = TensorList()
         result.shielding_type = self.shielding_type
         result.filename = self.filename
-        result.file_type = "Gaussian 0X output"
-        tensor_block = None
-        check_index = False
-        if self.max_index > 0:
-            check_index = True
-            
+        result.file_type = self.__class__._file_type
 
-        with open(self.filename, 'r') as f:
-            try:
-                for line in f:
-                    if self.__class__._section_begin in line:
-                        section_found = True
-                        continue
+        with input_file(self.filename, self.fileobj) as f:
+            # read only the selected blocks when the file is indexed, 
+            # otherwise jump directly to the NMR section and fall back to line 
+            # by line scanning for streams and files which can not be 
+            # memory-mapped
+            index = self._load_index()
+            if index is not None:
+                blocks = self._read_blocks(f, index)
+            else:
+                lines = None
+                if self._is_plain():
+                    lines = self._map_section(f)
+                if lines is None:
+                    lines = self._scan_section(f)
+                blocks = self._iter_blocks(lines)
 
-                    if section_found:
-                        if self.__class__._section_end in line:
-                            result.append(
-                                self._process_block(
-                                    tensor_block
-                                )
-                            )
-                            break
-
-                        elif self.__class__._tensor_begin in line: 
-                            if tensor_block is None:
-                                tensor_block = []
-                            else:
-                                result.append(
-                                    self._process_block(
-                                        tensor_block,
-                                        check_index = check_index
-                                    )
-                                )
-                                tensor_block = []
+            try:
+                blocks = list(blocks)
 
-                        tensor_block.append(
-                            line
-                        )
-            except NMRFinishReadException:
-                return result
+                if isinstance(result, ColumnarTensorList):
+                    (indices, elements, eigenvalues, eigenvectors, cartesian, 
+                        finished) = self._decode_blocks(blocks)
+                    result.append_arrays(
+                        indices,
+                        elements,
+                        eigenvalues,
+                        eigenvectors
+                    )
+                else:
+                    (tensors, finished) = self._make_tensors(blocks)
+                    for t in tensors:
+                        result.append(t)
             except (TypeError, ValueError, IndexError):
                 raise NMRTensorReadError("Failed to read Gaussian NMR tensor")
 
@@ -167,14 +594,33 @@ class ADFOutputParser(object):
         r'\s*(?P<elem>[A-Za-z]{1,2})\((?P<index>\d+)\)\s*'
     )
     _nmr_end = 'N M R   E X I T'
+    _geometry_header = 'Coordinates (Cartesian)'
 
     def __init__(
         self,
         filename,
         shielding_type = 'total',
         atom_numbering = 'input',
+        columnar = False,
+        max_index = 0,
+        selection = None,
+        cache = None,
+        use_index = True,
+        fileobj = None,
+        **kwargs
     ):
         self.filename = filename
+        # already opened input (e.g. member of tar archive) read instead of
+        # opening 'filename', which then serves only as a label
+        self.fileobj = fileobj
+        self.columnar = columnar
+        # optional ParseCache consulted by read()
+        self.cache = cache
+        # seek to the data using up-to-date OutputIndex if there is one
+        self.use_index = use_index
+        self.max_index = max_index
+        # AtomSelection applied before the data of nucleus block are parsed
+        self.selection = selection
 
         self.shielding_type = shielding_type
         self.atom_numbering = atom_numbering
@@ -195,38 +641,6 @@ class ADFOutputParser(object):
     def get_shielding_type(self):
         return self.__shielding_type
 
-    def process_block(
-        self,
-        block,
-    ):
-        result = SigmaTensor()
-
-        (result.index, result.element) = ADFOutputParser.parse_element_index(
-            block[0][1]
-        )
-        if self.max_index > 0 and result.index == self.max_index:
-            return None
-        result.shielding_type = self.shielding_type
-
-        result.eigenvalues = array(
-            map(
-                float,
-                block[1][0:4]
-            )
-        )
-            
-            
-        principal_axes = array(
-            [
-                map(float, i)
-                for i in block[3:7]
-            ]
-        )
-
-        result.eigenvectors = principal_axes.T
-
-        return result
-
     def parse_element_index(
         self,
         arg
@@ -246,13 +660,78 @@ class ADFOutputParser(object):
     def read(
         self,
     ):
+        if self.cache is not None:
+            return self.cache.read(self)
 
-        result = TensorList(
-            filename = self.filename,
-            file_type = ADFOutputParser._file_type,
-        )      
+        return self._read()
 
-        with open(self.filename, 'r') as inp_file:
+    def _read(
+        self,
+    ):
+
+        if self.columnar:
+            result = ColumnarTensorList(
+                filename = self.filename,
+                file_type = ADFOutputParser._file_type,
+            )
+        else:
+            result = TensorList(
+                filename = self.filename,
+                file_type = ADFOutputParser._file_type,
+            )      
+
+        for tensor in self.iter_tensors():
+            result.append(tensor)
+
+        result.shielding_type = self.shielding_type
+        return result
+
+    def iter_tensors(
+        self,
+    ):
+        '''
+        generator yielding SigmaTensor instances one by one as the nucleus 
+        blocks are read, without building the whole TensorList
+        '''
+        for tensors in self.iter_tensor_sets([self.shielding_type]):
+            yield tensors[self.shielding_type]
+
+    def iter_tensor_sets(
+        self,
+        shielding_types
+    ):
+        '''
+        generator yielding for each nucleus block a dictionary of SigmaTensor 
+        instances of all requested 'shielding_types', read in a single pass
+        '''
+        for t in shielding_types:
+            if t not in self.__class__._shielding_types:
+                raise ValueError(
+                    "Unrecognized shielding type \"%s\"" % t
+                )
+
+        # indices of requested atoms not read so far, once all of them are
+        # found there is no need to read the rest of the file
+        remaining = self._get_requested_indices()
+
+        with input_file(self.filename, self.fileobj) as inp_file:
+
+            index = self._load_index()
+            if index is not None:
+                if index.input_echo is not None:
+                    inp_file.seek(index.input_echo[0])
+                    self._check_outp_type(inp_file)
+
+                ranges = index.get_blocks(self.atom_numbering, self._is_selected)
+                for data in _read_ranges(inp_file, ranges):
+                    tensors = self._process_block(
+                        StringIO(data),
+                        shielding_types = shielding_types
+                    )
+
+                    if tensors is not None:
+                        yield tensors
+                return
 
             line = '\n'
 
@@ -266,15 +745,138 @@ class ADFOutputParser(object):
                     self._check_outp_type(inp_file)
 
                 if ADFOutputParser._nucleus_blk_begin in line:
-                    result.append(
-                        self._process_block(
-                            inp_file, 
-                        )
+                    tensors = self._process_block(
+                        inp_file, 
+                        remaining = remaining,
+                        shielding_types = shielding_types
                     )
-            
-        result.shielding_type = self.shielding_type
+
+                    if tensors is not None:
+                        yield tensors
+
+                    if remaining is not None and len(remaining) == 0:
+                        break
+
+    def read_multiple(
+        self,
+        shielding_types
+    ):
+        '''
+        read several shielding types (e.g. total, diamagnetic and 
+        paramagnetic) in one pass over the file and return dictionary of
+        TensorList instances indexed by the shielding type
+        '''
+        result = {}
+        for t in shielding_types:
+            if self.columnar:
+                result[t] = ColumnarTensorList(
+                    filename = self.filename,
+                    file_type = ADFOutputParser._file_type,
+                    shielding_type = t
+                )
+            else:
+                result[t] = TensorList(
+                    filename = self.filename,
+                    file_type = ADFOutputParser._file_type,
+                    shielding_type = t
+                )
+
+        for tensors in self.iter_tensor_sets(shielding_types):
+            for t in shielding_types:
+                result[t].append(tensors[t])
+
         return result
      
+    def _is_plain(self):
+        '''
+        return True when the input is plain file which can be memory-mapped 
+        and indexed
+        '''
+        return self.fileobj is None and is_plain_file(self.filename)
+
+    def _load_index(self):
+        if not self.use_index or not self._is_plain():
+            return None
+
+        return OutputIndex.load(self.filename, self.__class__._file_type)
+
+    def build_index(
+        self
+    ):
+        '''
+        scan the file and return OutputIndex holding offsets of the input 
+        echo, of the nucleus blocks (recorded under both atom numbering types) 
+        and of the last printed geometry
+        '''
+        cls = self.__class__
+        if not self._is_plain():
+            raise NMRTensorReadError(
+                "Only plain files can be indexed"
+            )
+
+        index = OutputIndex(self.filename, cls._file_type)
+
+        with open(self.filename, 'rb') as f:
+            mm = _map_file(f)
+            if mm is None:
+                return index
+
+            try:
+                pos = mm.rfind(cls._geometry_header)
+                if pos >= 0:
+                    index.geometry = mm.rfind('\n', 0, pos) + 1
+
+                nmr_end = mm.find(cls._nmr_end)
+                if nmr_end < 0:
+                    nmr_end = mm.size()
+                    section_end = nmr_end
+                else:
+                    section_end = mm.find('\n', nmr_end) + 1 or mm.size()
+
+                pos = mm.find(cls._job_type_blk_begin, 0, nmr_end)
+                if pos >= 0:
+                    mm.seek(mm.find('\n', pos) + 1 or mm.size())
+                    line = mm.readline()
+                    while line != '' and \
+                        line.strip().lower() != cls._job_type_blk_end:
+                        line = mm.readline()
+                    index.input_echo = [mm.find('\n', pos) + 1, mm.tell()]
+
+                pos = mm.find(cls._nucleus_blk_begin, 0, nmr_end)
+                if pos >= 0:
+                    index.section = [mm.rfind('\n', 0, pos) + 1, section_end]
+
+                while pos >= 0:
+                    begin = mm.find('\n', pos) + 1
+                    if begin == 0:
+                        break
+
+                    stop = mm.find(cls._nucleus_blk_end, begin)
+                    if stop < 0:
+                        end = mm.size()
+                    else:
+                        end = mm.find('\n', stop) + 1 or mm.size()
+
+                    block = mm[begin:end]
+                    element = ""
+                    indices = {}
+                    for (numbering, marker) in cls._atom_numbering.items():
+                        k = block.find(marker)
+                        if k >= 0:
+                            (indices[numbering], element) = \
+                                self.parse_element_index(
+                                    block[k:].split('\n', 1)[0].split(':')[1]
+                                )
+                        else:
+                            indices[numbering] = 0
+
+                    index.add_block(begin, end, element, indices)
+                    pos = mm.find(cls._nucleus_blk_begin, end, nmr_end)
+            finally:
+                mm.close()
+
+        return index
+
     def _check_outp_type(
         self,
         f
@@ -294,54 +896,138 @@ class ADFOutputParser(object):
 
 
 
+    def _get_requested_indices(self):
+        '''
+        return set of indices of atoms which can be selected, or None if any
+        atom can be
+        '''
+        result = None
+        if self.max_index > 0:
+            result = set(xrange(1, self.max_index + 1))
+
+        if self.selection is not None:
+            indices = self.selection.get_index_set()
+            if indices is not None:
+                if result is None:
+                    result = indices
+                else:
+                    result &= indices
+
+        return result
+
+    def _is_selected(
+        self,
+        index,
+        element
+    ):
+        if self.max_index > 0 and index > self.max_index:
+            return False
+
+        if self.selection is not None:
+            return self.selection.is_selected(index, element)
+
+        return True
+
     def _process_block(
         self,
         f,
+        remaining = None,
+        shielding_types = None
     ):
+        '''
+        read one nucleus block and return dictionary of SigmaTensor instances
+        for all 'shielding_types' (only the parser's shielding type by 
+        default), or None when the atom is not selected
+        '''
+        if shielding_types is None:
+            shielding_types = [self.shielding_type]
+
         line = ''
-        block = []
-        shield_blk_found = False
-
-        result = SigmaTensor()
-        shielding_type_line = ' '.join(
-            [
-                self.__class__._shielding_blk_delim,
-                self.__class__._shielding_types[self.shielding_type]
-            ]
+        index = 0
+        element = ""
+        blocks = dict((t, []) for t in shielding_types)
+        done = set()
+        # shielding type of the block being currently read
+        current = None
+
+        shielding_type_lines = dict(
+            (
+                ' '.join(
+                    [
+                        self.__class__._shielding_blk_delim,
+                        self.__class__._shielding_types[t]
+                    ]
+                ), 
+                t
+            ) for t in shielding_types
         )
 
         while not ADFOutputParser._nucleus_blk_end in line:
-            line = f.readline().strip()
+            line = f.readline()
+            if line == '':
+                break
+            line = line.strip()
 
             if ADFOutputParser._atom_numbering[self.atom_numbering] in line:
-                (result.index, result.element) = \
+                (index, element) = \
                     self.parse_element_index(
                         line.split(':')[1]
                     )
+
+                if remaining is not None:
+                    remaining.discard(index)
+
+                if not self._is_selected(index, element):
+                    self._skip_block(f, line)
+                    return None
                 continue
 
-            if shielding_type_line in line:
-                shield_blk_found = True
+            if ADFOutputParser._shielding_blk_delim in line:
+                if current is not None:
+                    done.add(current)
+                    if len(done) == len(blocks):
+                        break
+
+                current = None
+                for (type_line, t) in shielding_type_lines.items():
+                    if type_line in line:
+                        current = t
                 continue
 
-            if shield_blk_found:
-                if ADFOutputParser._shielding_blk_delim in line:
-                    break
-                elif len(line) != 0:
-                    block.append(
-                        line
-                    )
-                else:
-                    continue
+            if current is not None and len(line) != 0:
+                blocks[current].append(
+                    line
+                )
+
+        result = {}
+        for t in shielding_types:
+            tensor = SigmaTensor(
+                element = element,
+                index = index,
+                shielding_type = t
+            )
+            self.output_types[self.outp_type](
+                blocks[t],
+                tensor
+            )
+            result[t] = tensor
 
-        #print block
-        self.output_types[self.outp_type](
-            block,
-            result
-        )
         return result
             
 
+    def _skip_block(
+        self,
+        f,
+        line
+    ):
+        '''
+        skip the rest of nucleus block without any further processing
+        '''
+        while not ADFOutputParser._nucleus_blk_end in line:
+            line = f.readline()
+            if line == '':
+                break
+
     def _parse_iso_block(
         self,
         block,
@@ -385,3 +1071,131 @@ class ADFOutputParser(object):
             )
 
     shielding_type = property(get_shielding_type, set_shielding_type)
+
+
+def _read_file(args):
+    '''
+    read a single file by a fresh parser instance. Module-level function so 
+    that it can be used as a process pool worker
+    '''
+    (parser_class, filename, kwargs) = args
+
+    try:
+        return (filename, parser_class(filename, **kwargs).read(), None)
+    except (NMRTensorReadError, IOError), e:
+        return (filename, None, e)
+
+def read_archive(
+    parser_class,
+    filename,
+    skip_member = None,
+    **kwargs
+):
+    '''
+    generator reading regular files stored in tar archive one by one as the 
+    archive is streamed, without extracting them to disk. Every member is read
+    by a separate 'parser_class' instance constructed with 'kwargs', tuples 
+    (name, TensorList) are yielded, where name is the member path appended to 
+    the archive filename. Members for which 'skip_member' called with the
+    archive filename and TarInfo of the member returns True are not read
+    '''
+    skip = None
+    if skip_member is not None:
+        skip = lambda member: skip_member(filename, member)
+
+    try:
+        for (member_name, member) in iter_archive(filename, skip = skip):
+            name = os.path.join(filename, member_name)
+            (name, tens_list, error) = _read_file(
+                (parser_class, name, dict(kwargs, fileobj = member))
+            )
+
+            if error is not None:
+                if getattr(error, 'filename', None) is None:
+                    error.filename = name
+                raise error
+
+            yield (name, tens_list)
+    except tarfile.TarError, e:
+        error = NMRTensorReadError("Invalid tar archive: %s" % e)
+        error.filename = filename
+        raise error
+
+def read_files(
+    parser_class,
+    filenames,
+    jobs = 1,
+    ordered = False,
+    skip_member = None,
+    **kwargs
+):
+    '''
+    generator parsing 'filenames' in a pool of 'jobs' processes. Every file is 
+    read by a separate 'parser_class' instance constructed with 'kwargs', 
+    tuples (filename, TensorList) are yielded as soon as the files are parsed
+    (in the order of 'filenames' if 'ordered' is set). Members of tar archives
+    found among 'filenames' are read serially by read_archive() ('skip_member'
+    is passed to it). Read errors are raised when the result of the failed 
+    file is reached
+    '''
+    plain = []
+
+    for fn in filenames:
+        if is_archive(fn):
+            for result in _read_pool(parser_class, plain, jobs, ordered, kwargs):
+                yield result
+            plain = []
+
+            for result in read_archive(
+                parser_class,
+                fn,
+                skip_member = skip_member,
+                **kwargs
+            ):
+                yield result
+        else:
+            plain.append(fn)
+
+    for result in _read_pool(parser_class, plain, jobs, ordered, kwargs):
+        yield result
+
+def _read_pool(
+    parser_class,
+    filenames,
+    jobs,
+    ordered,
+    kwargs
+):
+    if len(filenames) == 0:
+        return
+
+    tasks = ((parser_class, fn, kwargs) for fn in filenames)
+
+    if jobs > 1:
+        pool = Pool(jobs)
+        if ordered:
+            results = pool.imap(_read_file, tasks)
+        else:
+            results = pool.imap_unordered(_read_file, tasks)
+    else:
+        pool = None
+        results = (_read_file(t) for t in tasks)
+
+    try:
+        for (filename, tens_list, error) in results:
+            if error is not None:
+                if getattr(error, 'filename', None) is None:
+                    error.filename = filename
+                raise error
+
+            yield (filename, tens_list)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
@@ -0,0 +1,236 @@
+"""
+On-disk store of per-snapshot tensor samples. All samples live in a single
+raw array (snapshots x atoms x components) accompanied by the table of atoms
+and the list of snapshot labels, so that it can be memory-mapped and read by
+atom or by snapshot, and new snapshots are simply appended to its end.
+"""
+import os
+import json
+from numpy import array, asarray, zeros, empty, nan, int64, float64, \
+    memmap, searchsorted, unique, dtype, in1d, concatenate, argsort, where
+
+class SampleStore(object):
+    '''
+    store of samples in directory 'path' consisting of three files: raw
+    array of samples (C order, snapshots x atoms x components), JSON
+    description of atoms and components and text file with one label (e.g.
+    source file name) per snapshot. The table of atoms is taken from the
+    first snapshot appended and extended by atoms new in later snapshots
+    (the snapshots already stored are rewritten with NaN for them), atoms
+    missing in a snapshot are stored as NaN
+    '''
+    _data_filename = 'samples.dat'
+    _meta_filename = 'samples.json'
+    _labels_filename = 'labels.txt'
+    _version = 1
+    _dtype = dtype(float64).newbyteorder('<')
+
+    def __init__(self, path):
+        self.path = path
+        self.indices = None
+        self.elements = None
+        self.components = None
+
+        meta_filename = os.path.join(path, self.__class__._meta_filename)
+        if os.path.exists(meta_filename):
+            self._read_meta(meta_filename)
+
+    def _read_meta(self, meta_filename):
+        try:
+            with open(meta_filename, 'r') as f:
+                meta = json.load(f)
+
+            if meta['version'] != self.__class__._version:
+                raise ValueError("Unsupported version")
+
+            self.indices = array(meta['indices'], dtype = int64)
+            self.elements = [str(e) for e in meta['elements']]
+            self.components = [str(c) for c in meta['components']]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(
+                "Invalid sample store description \"%s\"" % meta_filename
+            )
+
+    def _create(self, indices, elements, components):
+        '''
+        set up new store with atoms sorted by their index
+        '''
+        (indices, first) = unique(asarray(indices, dtype = int64),
+            return_index = True)
+        self.indices = indices
+        self.elements = [str(elements[k]) for k in first]
+        self.components = [str(c) for c in components]
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self._write_meta()
+
+        # start with empty data and labels
+        open(self._get_filename('_data_filename'), 'wb').close()
+        open(self._get_filename('_labels_filename'), 'w').close()
+
+    def _write_meta(self):
+        meta = {
+            'version' : self.__class__._version,
+            'dtype' : self.__class__._dtype.str,
+            'indices' : self.indices.tolist(),
+            'elements' : self.elements,
+            'components' : self.components
+        }
+
+        with open(self._get_filename('_meta_filename'), 'w') as f:
+            json.dump(meta, f)
+
+    def _extend(self, indices, elements):
+        '''
+        add atoms of 'indices' missing in the table, the snapshots stored so
+        far are rewritten (one by one) with NaN samples of the new atoms
+        '''
+        indices = asarray(indices, dtype = int64)
+        new = where(~in1d(indices, self.indices))[0]
+        if new.shape[0] == 0:
+            return
+
+        (new_indices, first) = unique(indices[new], return_index = True)
+        all_indices = concatenate([self.indices, new_indices])
+        all_elements = self.elements + \
+            [str(elements[k]) for k in new[first]]
+        order = argsort(all_indices, kind = 'mergesort')
+        # positions of the old atoms in the extended table
+        old_columns = argsort(order)[:self.indices.shape[0]]
+
+        samples = self.get_samples()
+        data_filename = self._get_filename('_data_filename')
+        temp_filename = data_filename + '.tmp'
+        snapshot = empty(
+            (all_indices.shape[0], len(self.components)),
+            dtype = self.__class__._dtype
+        )
+        with open(temp_filename, 'wb') as f:
+            for k in xrange(samples.shape[0]):
+                snapshot.fill(nan)
+                snapshot[old_columns] = samples[k]
+                f.write(snapshot.tostring())
+        del samples
+
+        os.rename(temp_filename, data_filename)
+
+        self.indices = all_indices[order]
+        self.elements = [all_elements[k] for k in order]
+        self._write_meta()
+
+    def _get_filename(self, name):
+        return os.path.join(self.path, getattr(self.__class__, name))
+
+    def get_columns(self, indices):
+        '''
+        return columns (positions in the atom table) of atoms with 'indices',
+        raise ValueError for atoms not in the table
+        '''
+        indices = asarray(indices, dtype = int64)
+        if indices.shape[0] == 0:
+            return zeros(0, dtype = int64)
+
+        columns = searchsorted(self.indices, indices)
+        columns[columns == self.indices.shape[0]] = 0
+
+        if (self.indices[columns] != indices).any():
+            raise ValueError(
+                "Atoms not present in the sample store"
+            )
+
+        return columns
+
+    def append(
+        self,
+        indices,
+        elements,
+        values,
+        label = '',
+        components = ('iso', '11', '22', '33')
+    ):
+        '''
+        append one snapshot given as atom indices, element symbols and
+        (atoms x components) array of values. 'components' name the columns
+        of 'values' when the store is created by this call
+        '''
+        values = asarray(values, dtype = float64)
+
+        if self.indices is None:
+            self._create(indices, elements, components)
+
+        if values.shape[1] != len(self.components):
+            raise ValueError(
+                "Expected %d components of samples, got %d" % \
+                    (len(self.components), values.shape[1])
+            )
+
+        self._extend(indices, elements)
+
+        snapshot = empty(
+            (self.indices.shape[0], len(self.components)),
+            dtype = self.__class__._dtype
+        )
+        snapshot.fill(nan)
+        snapshot[self.get_columns(indices)] = values
+
+        with open(self._get_filename('_data_filename'), 'ab') as f:
+            f.write(snapshot.tostring())
+
+        with open(self._get_filename('_labels_filename'), 'a') as f:
+            f.write(label.replace('\n', ' ') + '\n')
+
+    def __len__(self):
+        '''
+        return number of complete snapshots stored
+        '''
+        if self.indices is None:
+            return 0
+
+        snapshot_size = self.indices.shape[0] * len(self.components) * \
+            self.__class__._dtype.itemsize
+        if snapshot_size == 0:
+            return 0
+
+        return os.path.getsize(self._get_filename('_data_filename')) // \
+            snapshot_size
+
+    def get_samples(self):
+        '''
+        return read-only memory map of all samples (snapshots x atoms x
+        components)
+        '''
+        n = len(self)
+        if n == 0:
+            if self.indices is None:
+                return zeros((0, 0, 0))
+            return zeros((0, self.indices.shape[0], len(self.components)))
+
+        return memmap(
+            self._get_filename('_data_filename'),
+            dtype = self.__class__._dtype,
+            mode = 'r',
+            shape = (n, self.indices.shape[0], len(self.components))
+        )
+
+    def get_atom(self, index):
+        '''
+        return (snapshots x components) samples of atom with 'index'
+        '''
+        return self.get_samples()[:, self.get_columns([index])[0], :]
+
+    def get_snapshot(self, k):
+        '''
+        return (atoms x components) samples of k-th snapshot
+        '''
+        return self.get_samples()[k]
+
+    def get_labels(self):
+        if self.indices is None:
+            return []
+
+        with open(self._get_filename('_labels_filename'), 'r') as f:
+            labels = [l.rstrip('\n') for l in f]
+
+        return labels[:len(self)]
@@ -0,0 +1,373 @@
+"""
+Error estimates of mean values of correlated samples, e.g. of NMR parameters
+averaged over consecutive snapshots of molecular dynamics. All the functions
+take arrays with samples along the first axis (e.g. snapshots x atoms x
+components) and process all the other elements at once, columns are only
+split into chunks to limit the memory used.
+"""
+import warnings
+from numpy import asarray, array, ones, zeros, empty, sqrt, ceil, log2, \
+    arange, newaxis, errstate, where, isnan, isfinite, maximum, logical_and, \
+    nan, nanmax, percentile, dot, bincount, repeat, prod, cumsum, int64, \
+    append, concatenate
+from numpy.fft import rfft, irfft
+from numpy.random import RandomState
+
+# approximate size in bytes of temporary arrays of columns (e.g. atoms x 
+# components) processed at once, the number of columns in a chunk is derived
+# from the memory needed per column, which grows with the number of samples
+_chunk_bytes = 1 << 27
+# number of temporary arrays of column size, e.g. copy of the samples and 
+# arrays derived from it
+_column_arrays = 4
+
+def _as_columns(samples):
+    '''
+    return samples as (samples x columns) array and the shape of one sample
+    '''
+    samples = asarray(samples, dtype = float)
+    shape = samples.shape[1:]
+    return (samples.reshape(samples.shape[0], int(prod(shape))), shape)
+
+def _iter_chunks(n_columns, column_length):
+    '''
+    generator yielding slices of chunks of 'n_columns' columns, each needing
+    temporary arrays of 'column_length' floats
+    '''
+    step = max(1, _chunk_bytes // (8 * _column_arrays * max(1, column_length)))
+    for begin in xrange(0, n_columns, step):
+        yield slice(begin, min(begin + step, n_columns))
+
+def _split_finite(block):
+    '''
+    generator splitting columns of (samples x columns) 'block' to groups with
+    finite samples in the same rows (e.g. components of an atom missing in 
+    some snapshots) and yielding (columns, samples) of each group, where 
+    samples is (finite rows x columns) array, i.e. missing (NaN) samples are
+    dropped
+    '''
+    finite = isfinite(block)
+    if finite.all():
+        yield (slice(None), block)
+        return
+
+    groups = {}
+    for k in xrange(block.shape[1]):
+        groups.setdefault(finite[:, k].tostring(), []).append(k)
+
+    for columns in groups.itervalues():
+        rows = finite[:, columns[0]]
+        columns = array(columns, dtype = int64)
+        yield (columns, block[rows][:, columns])
+
+def _iter_finite(x, column_length = None):
+    '''
+    generator yielding (chunk, columns, samples) for finite samples of 
+    (samples x columns) array 'x' split to chunks of columns (each column
+    needing temporary arrays of 'column_length' floats, the number of 
+    samples by default) and to groups of _split_finite, 'columns' index the 
+    chunk
+    '''
+    if column_length is None:
+        column_length = x.shape[0]
+
+    for chunk in _iter_chunks(x.shape[1], column_length):
+        for (columns, samples) in _split_finite(array(x[:, chunk])):
+            yield (chunk, columns, samples)
+
+def naive_sem(samples):
+    '''
+    return standard error of the mean assuming independent samples, missing
+    (NaN) samples are skipped
+    '''
+    (x, shape) = _as_columns(samples)
+    result = empty(x.shape[1])
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        with warnings.catch_warnings():
+            # columns with less than two samples
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for (chunk, columns, y) in _iter_finite(x):
+                result[chunk][columns] = y.std(axis = 0, ddof = 1) / \
+                    sqrt(y.shape[0])
+
+    return result.reshape(shape)
+
+def _block_counts(n):
+    '''
+    return numbers of blocks at the levels of blocking transformation of 'n'
+    samples
+    '''
+    counts = []
+    while n >= 2:
+        counts.append(n)
+        n //= 2
+
+    return counts
+
+def block_sems(samples):
+    '''
+    return tuple of (levels x ...) arrays of estimates of the standard error
+    of the mean obtained by blocking transformation (Flyvbjerg and Petersen)
+    and of numbers of blocks they were obtained from. The first level are 
+    the samples themselves, at each next level neighbouring blocks are 
+    averaged in pairs (odd trailing block is dropped). Missing (NaN) samples
+    are skipped, so columns with fewer samples have fewer levels, the 
+    estimates of the missing levels are NaN with no blocks
+    '''
+    (x, shape) = _as_columns(samples)
+    n_levels = len(_block_counts(x.shape[0]))
+
+    result = empty((n_levels, x.shape[1]))
+    result.fill(nan)
+    counts = zeros((n_levels, x.shape[1]), dtype = int64)
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        for (chunk, columns, blocks) in _iter_finite(x):
+            for (level, n) in enumerate(_block_counts(blocks.shape[0])):
+                blocks = blocks[:n]
+                result[level, chunk][columns] = \
+                    blocks.std(axis = 0, ddof = 1) / sqrt(n)
+                counts[level, chunk][columns] = n
+                m = n // 2
+                blocks = 0.5 * (blocks[0:2 * m:2] + blocks[1:2 * m:2])
+
+    levels_shape = (n_levels,) + shape
+    return (result.reshape(levels_shape), counts.reshape(levels_shape))
+
+def block_sem(
+    samples,
+    min_blocks = 16
+):
+    '''
+    return standard error of the mean estimated by blocking transformation.
+    The estimates grow with the block length until the blocks are longer
+    than the correlation time, the largest estimate of levels with at least
+    'min_blocks' blocks is taken (the first level if there are too few
+    samples)
+    '''
+    (sems, counts) = block_sems(samples)
+    if sems.shape[0] == 0:
+        result = empty(sems.shape[1:])
+        result.fill(nan)
+        return result
+
+    usable = counts >= min_blocks
+    usable[0] = True
+
+    with warnings.catch_warnings():
+        # columns with less than two samples
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return nanmax(where(usable, sems, nan), axis = 0)
+
+def _inefficiency(y, max_lag):
+    '''
+    return statistical inefficiency of columns of (samples x columns) array
+    'y' without missing samples
+    '''
+    n = y.shape[0]
+    if n < 2:
+        return ones(y.shape[1])
+
+    if max_lag is None or max_lag > n - 1:
+        max_lag = n - 1
+
+    lags = arange(max_lag + 1)
+    weights = (1.0 - lags[1:] / float(n))[:, newaxis]
+    # zero padding avoids circular correlation
+    size = 2 ** int(ceil(log2(2 * n)))
+
+    dx = y - y.mean(axis = 0)
+    f = rfft(dx, n = size, axis = 0)
+    acov = irfft(f * f.conj(), n = size, axis = 0)[:max_lag + 1]
+    acov /= (n - lags)[:, newaxis]
+
+    acf = acov[1:] / acov[0]
+    positive = logical_and.accumulate(acf > 0, axis = 0)
+    g = 1.0 + 2.0 * (where(positive, acf, 0.0) * weights).sum(axis = 0)
+
+    g = where(acov[0] > 0, g, 1.0)
+    g[isnan(acov[0])] = nan
+    return maximum(g, 1.0)
+
+def statistical_inefficiency(
+    samples,
+    max_lag = None
+):
+    '''
+    return statistical inefficiency g = 1 + 2 sum_t (1 - t/N) C(t), where
+    C(t) is normalized autocorrelation function at lag t summed up to its
+    first non-positive value (or up to 'max_lag'), see Chodera et al., J.
+    Chem. Theory Comput. 3, 26 (2007). N/g is the number of effectively
+    independent samples, g is 1 for uncorrelated or constant samples. The
+    autocorrelation functions are calculated by FFT, missing (NaN) samples
+    are skipped
+    '''
+    (x, shape) = _as_columns(samples)
+    result = ones(x.shape[1])
+    # zero-padded transforms dominate the memory used
+    fft_length = 2 ** int(ceil(log2(2 * max(1, x.shape[0]))))
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        for (chunk, columns, y) in _iter_finite(x, fft_length):
+            result[chunk][columns] = _inefficiency(y, max_lag)
+
+    return result.reshape(shape)
+
+def inefficiency_sem(
+    samples,
+    max_lag = None
+):
+    '''
+    return standard error of the mean corrected for correlation of samples by
+    their statistical inefficiency
+    '''
+    return naive_sem(samples) * \
+        sqrt(statistical_inefficiency(samples, max_lag = max_lag))
+
+def _bootstrap_weights(n, n_resamples, block_size, seed):
+    '''
+    return (resamples x samples) matrix of resampling counts of moving block
+    bootstrap of 'n' samples divided by 'n'
+    '''
+    block_size = max(1, min(int(block_size), n))
+    n_blocks = int(ceil(n / float(block_size)))
+
+    random = RandomState(seed)
+    starts = random.randint(
+        0,
+        n - block_size + 1,
+        size = (n_resamples, n_blocks)
+    )
+    positions = (starts[:, :, newaxis] + arange(block_size)).reshape(
+        n_resamples,
+        -1
+    )[:, :n]
+
+    return bincount(
+        (repeat(arange(n_resamples), n) * n + positions.ravel()),
+        minlength = n_resamples * n
+    ).reshape(n_resamples, n) / float(n)
+
+def bootstrap_errors(
+    samples,
+    n_resamples = 1000,
+    confidence = 0.95,
+    block_size = 1,
+    seed = None
+):
+    '''
+    return tuple (sem, ci) of standard deviation of bootstrap distribution
+    of the mean and half width of its percentile confidence interval.
+    Correlated samples are resampled in moving blocks of 'block_size'
+    consecutive samples, which should be longer than the correlation time.
+    All the columns are resampled together, so that the means of all
+    resamples are obtained as a single product of the matrix of resampling
+    counts and the samples. Missing (NaN) samples are skipped, i.e. columns
+    with fewer samples are resampled separately
+    '''
+    (x, shape) = _as_columns(samples)
+    sem = empty(x.shape[1])
+    ci = empty(x.shape[1])
+    sem.fill(nan)
+    ci.fill(nan)
+
+    # resampling counts of each number of samples
+    weights = {}
+    tail = 50.0 * (1.0 - confidence)
+    for (chunk, columns, y) in _iter_finite(x, x.shape[0] + n_resamples):
+        n = y.shape[0]
+        if n == 0:
+            continue
+        if n not in weights:
+            weights[n] = _bootstrap_weights(n, n_resamples, block_size, seed)
+
+        means = dot(weights[n], y)
+        (lower, upper) = percentile(
+            means,
+            [tail, 100.0 - tail],
+            axis = 0
+        )
+        sem[chunk][columns] = means.std(axis = 0, ddof = 1)
+        ci[chunk][columns] = 0.5 * (upper - lower)
+
+    return (sem.reshape(shape), ci.reshape(shape))
+
+def _segment_sums(a, stride, dtype = float):
+    '''
+    return sums of consecutive segments of 'stride' rows of 'a', the last 
+    segment may be shorter
+    '''
+    m = (a.shape[0] // stride) * stride
+    sums = a[:m].reshape(m // stride, stride, a.shape[1]).sum(
+        axis = 1, 
+        dtype = dtype
+    )
+    if m < a.shape[0]:
+        sums = concatenate(
+            [sums, a[m:].sum(axis = 0, dtype = dtype)[newaxis]]
+        )
+
+    return sums
+
+def calc_convergence(
+    samples,
+    stride = 1,
+    confidence_factor = 1.96
+):
+    '''
+    return tuple (snapshots, count, mean, ci) of convergence traces: numbers
+    of samples read at the points of the traces (after every 'stride'-th
+    sample and after the last one) and (points x ...) arrays of number of
+    valid samples, cumulative mean and naive confidence interval. Missing
+    (NaN) samples are skipped. All the points are obtained at once from
+    cumulative sums of deviations from the first valid sample (which keeps
+    the sums small) of the segments between the points
+    '''
+    (x, shape) = _as_columns(samples)
+    n = x.shape[0]
+
+    points = arange(stride - 1, n, stride)
+    if n > 0 and (points.shape[0] == 0 or points[-1] != n - 1):
+        points = append(points, n - 1)
+
+    count = empty((points.shape[0], x.shape[1]), dtype = int64)
+    mean = empty((points.shape[0], x.shape[1]))
+    confidence_int = empty((points.shape[0], x.shape[1]))
+
+    with errstate(divide = 'ignore', invalid = 'ignore'):
+        for chunk in _iter_chunks(x.shape[1], n):
+            if n == 0:
+                break
+
+            block = array(x[:, chunk])
+            valid = ~isnan(block)
+            first = block[valid.argmax(axis = 0), arange(block.shape[1])]
+            first[isnan(first)] = 0.0
+
+            deviations = where(valid, block - first, 0.0)
+            n_valid = cumsum(_segment_sums(valid, stride, int64), axis = 0)
+            sum_dev = cumsum(_segment_sums(deviations, stride), axis = 0)
+            sum_sq = cumsum(
+                _segment_sums(deviations * deviations, stride),
+                axis = 0
+            )
+
+            mean_dev = sum_dev / n_valid
+            variance = maximum(
+                (sum_sq - n_valid * mean_dev * mean_dev) / (n_valid - 1),
+                0.0
+            )
+
+            count[:, chunk] = n_valid
+            mean[:, chunk] = first + mean_dev
+            confidence_int[:, chunk] = confidence_factor * \
+                sqrt(variance / n_valid)
+
+    points_shape = (points.shape[0],) + shape
+    return (
+        points + 1,
+        count.reshape(points_shape),
+        mean.reshape(points_shape),
+        confidence_int.reshape(points_shape)
+    )
@@ -1,3 +1,4 @@
 ﻿import pyqmtools
 from .elements import PeriodicTable
-from .units import bohr2angstrom, hartree2kj, hartree2kjmol, hartree2kcalmol, gradqm2mm, hessqm2mm
\ No newline at end of file
+from .units import bohr2angstrom, hartree2kj, hartree2kjmol, hartree2kcalmol, gradqm2mm, hessqm2mm
+from .fileio import open_input, input_file, iter_archive, is_archive, is_plain_file
@@ -0,0 +1,120 @@
+"""
+Opening of input files which may be compressed, stored in tar archives or
+read from standard input. Everything is decompressed on the fly, nothing is
+extracted to disk.
+"""
+import sys
+import gzip
+import bz2
+import tarfile
+from contextlib import contextmanager
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # .xz files can not be read
+        lzma = None
+
+STDIN_NAME = '-'
+
+_compressed_suffixes = ('.gz', '.bz2', '.xz')
+_archive_suffixes = (
+    '.tar',
+    '.tar.gz',
+    '.tgz',
+    '.tar.bz2',
+    '.tbz2',
+    '.tar.xz',
+    '.txz'
+)
+
+def is_archive(filename):
+    '''
+    return True if 'filename' is tar archive (judged by its suffix)
+    '''
+    return filename.lower().endswith(_archive_suffixes)
+
+def is_plain_file(filename):
+    '''
+    return True if 'filename' can be read directly, i.e. it is neither
+    compressed nor standard input. Only plain files can be memory-mapped or
+    read by seeking to known offsets
+    '''
+    return filename != STDIN_NAME and \
+        not filename.lower().endswith(_compressed_suffixes)
+
+def _open_xz(filename):
+    if lzma is None:
+        raise IOError(
+            "Reading of .xz files requires the lzma module: \"%s\"" % filename
+        )
+
+    return lzma.open(filename, 'rb')
+
+def open_input(filename):
+    '''
+    open 'filename' for reading, decompressing .gz, .bz2 and .xz files on the
+    fly. '-' stands for standard input
+    '''
+    name = filename.lower()
+
+    if filename == STDIN_NAME:
+        return sys.stdin
+    elif name.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    elif name.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'rb')
+    elif name.endswith('.xz'):
+        return _open_xz(filename)
+
+    return open(filename, 'rb')
+
+@contextmanager
+def input_file(
+    filename,
+    fileobj = None
+):
+    '''
+    context manager yielding 'fileobj' if given, or file opened by
+    open_input() otherwise. Only files opened here are closed on exit,
+    standard input is left open
+    '''
+    if fileobj is not None:
+        yield fileobj
+        return
+
+    f = open_input(filename)
+    try:
+        yield f
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def iter_archive(filename, skip = None):
+    '''
+    generator yielding (name, file object) of regular files stored in tar
+    archive, which is read as a stream (possibly compressed, '-' stands for
+    standard input). Every member must be processed before the next one is
+    requested. Members for whose TarInfo 'skip' returns True are not read
+    '''
+    stream = None
+    if filename == STDIN_NAME:
+        tar = tarfile.open(fileobj = sys.stdin, mode = 'r|*')
+    elif filename.lower().endswith(('.xz', '.txz')):
+        # tarfile of Python 2 does not handle xz compression by itself
+        stream = _open_xz(filename)
+        tar = tarfile.open(fileobj = stream, mode = 'r|')
+    else:
+        tar = tarfile.open(filename, mode = 'r|*')
+
+    try:
+        for member in tar:
+            if member.isfile() and (skip is None or not skip(member)):
+                yield (member.name, tar.extractfile(member))
+    finally:
+        tar.close()
+        if stream is not None:
+            stream.close()
@@ -0,0 +1,165 @@
+import unittest
+import os
+import tempfile
+import shutil
+from numpy import array, isnan, isfinite, empty, sqrt, nan, arange, \
+    array_equal, allclose
+from numpy.random import RandomState
+
+from pyqmtools.nmr.datastruct import calc_tensor_descriptors, TensorStats
+from pyqmtools.nmr.samples import SampleStore
+from pyqmtools.nmr.histogram import StreamingHistograms
+from pyqmtools.nmr.uncertainty import naive_sem, block_sem, \
+    statistical_inefficiency, bootstrap_errors
+
+class TestTensorDescriptors(unittest.TestCase):
+    def test_isotropic_tensor(self):
+        descriptors = calc_tensor_descriptors(array([[30.0, 30.0, 30.0]]))
+
+        self.assertEqual(descriptors['span'][0], 0.0)
+        self.assertEqual(descriptors['skew'][0], 0.0)
+        self.assertEqual(descriptors['asymmetry'][0], 0.0)
+
+    def test_isotropic_tensor_in_stats(self):
+        stats = TensorStats()
+        for eigenvalues in ([30.0, 30.0, 30.0], [29.0, 30.0, 33.0]):
+            stats.add_arrays(
+                [1],
+                ['C'],
+                array([eigenvalues])
+            )
+
+        (count, mean, std_dev, std_err_mean, confidence_int) = \
+            stats.get_stats()
+
+        self.assertEqual(count[0], 2)
+        self.assertFalse(isnan(mean).any())
+        self.assertFalse(isnan(std_dev).any())
+        self.assertFalse(isnan(confidence_int).any())
+
+class TestRaggedSamples(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_atoms_missing_in_snapshots(self):
+        random = RandomState(0)
+        for method in TensorStats._error_methods:
+            stats = TensorStats(
+                sample_store = SampleStore(
+                    os.path.join(self.directory, method)
+                ),
+                error_method = method
+            )
+            for k in xrange(12):
+                # atom 5 only in every third snapshot
+                indices = [1, 2, 5] if k % 3 == 0 else [1, 2]
+                stats.add_arrays(
+                    indices,
+                    ['C'] * len(indices),
+                    100.0 + random.randn(len(indices), 3)
+                )
+
+            (count, mean, std_dev, std_err_mean, confidence_int) = \
+                stats.get_stats()
+
+            self.assertEqual(count.tolist(), [12, 12, 4])
+            self.assertTrue(isfinite(confidence_int[:, 0]).all(), method)
+
+def _ar1(phi, n, n_columns, random):
+    '''
+    return (n x n_columns) stationary AR(1) series with unit innovations
+    '''
+    noise = random.randn(n, n_columns)
+    result = empty((n, n_columns))
+    result[0] = noise[0] / sqrt(1.0 - phi ** 2)
+    for k in xrange(1, n):
+        result[k] = phi * result[k - 1] + noise[k]
+    return result
+
+class TestUncertainty(unittest.TestCase):
+    def setUp(self):
+        random = RandomState(0)
+        self.independent = random.randn(20000, 4)
+        # statistical inefficiency of AR(1) is (1 + phi) / (1 - phi) = 9
+        self.correlated = _ar1(0.8, 1 << 15, 8, random)
+
+    def test_naive_sem(self):
+        self.assertAlmostEqual(
+            naive_sem(array([1.0, 2.0, 3.0, 4.0])),
+            sqrt(5.0 / 3.0) / 2.0
+        )
+
+    def test_inefficiency_of_independent_samples(self):
+        g = statistical_inefficiency(self.independent)
+        self.assertTrue(((g >= 1.0) & (g < 1.1)).all())
+
+    def test_inefficiency_of_ar1(self):
+        g = statistical_inefficiency(self.correlated)
+        self.assertAlmostEqual(g.mean(), 9.0, delta = 0.9)
+
+    def test_block_sem_of_ar1(self):
+        ratio = block_sem(self.correlated) / naive_sem(self.correlated)
+        self.assertAlmostEqual(ratio.mean(), 3.0, delta = 0.5)
+
+    def test_bootstrap_of_independent_samples(self):
+        (sem, ci) = bootstrap_errors(self.independent, seed = 0)
+        ratio = sem / naive_sem(self.independent)
+        self.assertTrue((abs(ratio - 1.0) < 0.1).all())
+        self.assertTrue((abs(ci / sem - 1.96) < 0.15).all())
+
+    def test_missing_samples_are_skipped(self):
+        samples = self.correlated[:1000, :2].copy()
+        samples[::3, 1] = nan
+        finite = samples[~isnan(samples[:, 1]), 1]
+
+        for estimate in (naive_sem, block_sem, statistical_inefficiency):
+            self.assertAlmostEqual(estimate(samples)[1], estimate(finite))
+
+class TestStreamingHistograms(unittest.TestCase):
+    def _fill(self, values, origin):
+        histograms = StreamingHistograms(0.5, n_bins = 40, origin = origin)
+        rows = arange(values.shape[1])
+        for v in values:
+            histograms.update(rows, v)
+        return histograms
+
+    def test_merge_equals_single_pass(self):
+        random = RandomState(0)
+        values = 5.0 * random.randn(200, 3) + array([0.0, 3.0, -4.0])
+        # the parts start at different values
+        values[100] = [8.0, -6.0, 5.0]
+        rows = arange(3)
+
+        single = self._fill(values, -20)
+        merged = self._fill(values[100:], -20)
+        merged.merge(rows, self._fill(values[:100], -20), rows)
+
+        for name in ('counts', 'underflow', 'overflow', 'origin'):
+            self.assertTrue(
+                array_equal(getattr(merged, name), getattr(single, name)),
+                name
+            )
+        self.assertTrue(
+            allclose(
+                merged.get_percentiles(rows, (5, 50, 95)),
+                single.get_percentiles(rows, (5, 50, 95)),
+                equal_nan = True
+            )
+        )
+
+    def test_merge_of_different_bins(self):
+        values = array([[1.0], [2.0]])
+        histograms = self._fill(values, 0)
+        self.assertRaises(
+            ValueError,
+            histograms.merge,
+            [0],
+            self._fill(values, None),
+            [0]
+        )
+
+if __name__ == '__main__':
+    unittest.main()